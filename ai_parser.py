@@ -2,12 +2,22 @@ import os
 import base64
 import sys
 import json
+import signal
 import logging
 import asyncio
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, InternalServerError
 
-from services import update_link_record, get_links_for_parsing, get_campaigns
+from services import AsyncLinkUpdateBuffer, create_async_client, backoff_delay
+from rate_limiter import RateLimiter
+from llm_cache import ResponseCache, make_key
+from content_reducer import reduce_content, EMAIL_PATTERN
+from extractor import extract_fields, find_email
+from screenshots import prepare_screenshot, estimate_image_tokens
+from fingerprints import image_hash, text_hash, text_digest
+from utils import estimate_tokens, screenshot_path, NONE_SENTINELS
 
 # Classify 0-10
 # If more than X, parse content
@@ -18,7 +28,21 @@ if not api_key:
     print("No api key found in environment")
     sys.exit()
 
-client = AsyncOpenAI(api_key=api_key)
+# Retries are done by create_completion, so 429s reach the rate limiter
+client = AsyncOpenAI(api_key=api_key, max_retries=0)
+
+# Tokens reserved for the answer when estimating the size of a request
+completion_tokens = 300
+
+# Part of the response cache keys: bump the version when a prompt changes,
+# so responses to the old prompt are not reused
+extraction_model = "gpt-3.5-turbo-1106"
+extraction_prompt_version = "1"
+classification_model = "gpt-4-vision-preview"
+classification_prompt_version = "1"
+
+# Models tried in order, escalating while the answer scores below min_score
+default_extraction_tiers = [{"model": extraction_model, "min_score": 0}]
 
 
 system_message = {
@@ -27,22 +51,9 @@ system_message = {
 }
 
 
-def get_user_message(
-    content: str, keys: list, campaigns: list, extra_instructions: str = None
-):
-    user_message = {
-        "role": "user",
-        "content": f"""
-    Please extract the following information from the content. Remember not to translate the data, only return the raw normalized data i.e. no uppercase and only strings, no lists:
-
-    {', '.join(str(key) for key in keys)}
-
-    If you are not sure, write 'None'
-
-    CONTENT:
-    {content}
-
-    The key 'contact_name' can either be company name OR a name of a person. 
+def get_field_instructions(campaigns: list):
+    """How to fill in contact_name, pronoun, industry and area"""
+    return f"""The key 'contact_name' can either be company name OR a name of a person. 
     Sometimes the name of the person is reflected by the email. for example 'John' from john@example.com.
     Other times the person name is part of the business name, in that case please return just the person name.
     If you return an person name, only return the first name AND return the pronoun as 'du'. 
@@ -60,20 +71,155 @@ def get_user_message(
     In terms of area Only return one area, not a list. If there are more areas than one, just return the first. By area I mean city or greater area (for example a state).
     
     Do NOT add example data. If you are not sure, write 'None'
-    """,
+"""
+
+
+def get_user_message(
+    content: str, keys: list, campaigns: list, extra_instructions: str = None
+):
+    user_message = {
+        "role": "user",
+        "content": f"""
+    Please extract the following information from the content. Remember not to translate the data, only return the raw normalized data i.e. no uppercase and only strings, no lists:
+
+    {', '.join(str(key) for key in keys)}
+
+    If you are not sure, write 'None'
+
+    CONTENT:
+    {content}
+
+    {get_field_instructions(campaigns)}    """,
     }
     {extra_instructions}
 
     return user_message
 
 
+async def create_completion(
+    limiter: RateLimiter = None,
+    tokens: int = 0,
+    timeout: float = 20,
+    retries: int = 3,
+    **kwargs,
+):
+    """
+    Send a chat completion request.
+
+    Waits for the rate limiter first; the timeout only covers the request
+    itself. A 429 is reported to the limiter, which pauses every worker,
+    and is retried like connection errors and 5xx responses.
+
+    :param limiter: Optional rate limiter shared by all workers.
+    :param tokens: Estimated tokens of the request, prompt and answer.
+    :param kwargs: Arguments for client.chat.completions.create.
+    """
+    for attempt in range(retries + 1):
+        if limiter:
+            await limiter.acquire(tokens)
+
+        try:
+            raw = await asyncio.wait_for(
+                client.chat.completions.with_raw_response.create(**kwargs),
+                timeout=timeout,
+            )
+        except RateLimitError as e:
+            error = e
+            if limiter:
+                limiter.rate_limited(e.response.headers)
+        except (APIConnectionError, InternalServerError) as e:
+            error = e
+        else:
+            completion = raw.parse()
+            if limiter:
+                limiter.update(raw.headers)
+                if completion.usage:
+                    limiter.record_usage(tokens, completion.usage.total_tokens)
+            return completion
+
+        if attempt == retries:
+            raise error
+
+        # The limiter already waits out a 429
+        if not (limiter and isinstance(error, RateLimitError)):
+            await asyncio.sleep(backoff_delay(attempt))
+
+
 async def async_complete_chat(
-    content: str, keys: list, campaigns: list, extra_instructions: str = None
+    content: str,
+    keys: list,
+    campaigns: list,
+    extra_instructions: str = None,
+    limiter: RateLimiter = None,
+    model: str = extraction_model,
 ):
     message = get_user_message(content, keys, campaigns, extra_instructions)
 
-    completion = await client.chat.completions.create(
-        model="gpt-3.5-turbo-1106",
+    tokens = (
+        estimate_tokens(system_message["content"])
+        + estimate_tokens(message["content"])
+        + completion_tokens
+    )
+
+    completion = await create_completion(
+        limiter=limiter,
+        tokens=tokens,
+        model=model,
+        response_format={"type": "json_object"},
+        messages=[system_message, message],
+    )
+
+    return completion
+
+
+def get_packed_user_message(pages: list, campaigns: list):
+    """
+    One user message for several pages.
+
+    Each page is introduced by its link id and the keys wanted from it, and
+    the answer is a JSON object with an object per link id.
+    """
+    documents = "\n\n".join(
+        f"DOCUMENT {page['id']}\n"
+        f"KEYS: {', '.join(str(key) for key in page['keys'])}\n"
+        f"{page['content']}"
+        for page in pages
+    )
+
+    return {
+        "role": "user",
+        "content": f"""
+    Below are {len(pages)} documents, each the text of a different website. For every document please extract the keys listed under it. Remember not to translate the data, only return the raw normalized data i.e. no uppercase and only strings, no lists.
+
+    Return a JSON object with the document numbers as keys and an object with the extracted keys as values, for example {{"12": {{"e-mail": "..."}}}}. Keep the documents apart, never use data from one document in another.
+
+    If you are not sure, write 'None'
+
+    {get_field_instructions(campaigns)}
+    DOCUMENTS:
+    {documents}
+    """,
+    }
+
+
+async def async_complete_packed_chat(
+    pages: list,
+    campaigns: list,
+    limiter: RateLimiter = None,
+    model: str = extraction_model,
+):
+    message = get_packed_user_message(pages, campaigns)
+
+    tokens = (
+        estimate_tokens(system_message["content"])
+        + estimate_tokens(message["content"])
+        + completion_tokens * len(pages)
+    )
+
+    completion = await create_completion(
+        limiter=limiter,
+        tokens=tokens,
+        model=model,
         response_format={"type": "json_object"},
         messages=[system_message, message],
     )
@@ -95,61 +241,341 @@ def has_required_keys(json_obj, required_keys):
     return all(key in json_obj for key in required_keys)
 
 
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+def score_extraction(data: dict, keys: list, campaigns: list) -> float:
+    """
+    Share of the answered keys with a plausible value, from 0 to 1.
+
+    'None' answers are neutral, the prompt asks for them when the model is
+    unsure. Emails must look like emails, the pronoun must be 'du' or 'i'
+    and the industry one of the campaigns.
+    """
+    campaign_names = {str(campaign).lower() for campaign in campaigns}
+    answered = valid = 0
+    for key in keys:
+        value = data.get(key)
+        if value is None or (
+            isinstance(value, str) and value.strip().lower() in NONE_SENTINELS
+        ):
+            continue
+        answered += 1
+        if not isinstance(value, str):
+            continue
+        value = value.strip().lower()
+        if key == "e-mail" and not EMAIL_PATTERN.fullmatch(value):
+            continue
+        if key == "pronoun" and value not in ("du", "i"):
+            continue
+        if key == "industry" and campaign_names and value not in campaign_names:
+            continue
+        valid += 1
+
+    return valid / answered if answered else 1.0
 
 
 class AiParser:
-    def __init__(self, outfolder, keys):
+    def __init__(
+        self,
+        outfolder,
+        keys,
+        workers: int = 1,
+        requests_per_minute: int = 500,
+        tokens_per_minute: int = 60000,
+        cache: ResponseCache = None,
+        max_content_tokens: int = None,
+        fast_path: bool = True,
+        extraction_tiers: list = None,
+        pack_tokens: int = None,
+        image_width: int = 1024,
+        image_max_height: int = 1536,
+        image_quality: int = 70,
+        image_detail: str = "high",
+        image_workers: int = 2,
+        dedup_distance: int = None,
+    ):
         self.outfolder = outfolder
+        self.cache = cache
+        self.max_content_tokens = max_content_tokens
+        self.fast_path = fast_path
+        self.tiers = extraction_tiers or default_extraction_tiers
+        # Content tokens per packed request, None sends one page per request
+        self.pack_tokens = pack_tokens
+        self.image_width = image_width
+        self.image_max_height = image_max_height
+        self.image_quality = image_quality
+        self.image_detail = image_detail
+        self.image_workers = image_workers
+        # Screenshots are shrunk in worker processes, started on first use
+        self.image_pool = None
+        # Bits two fingerprints may differ by to count as near-duplicates,
+        # None turns the lookups off
+        self.dedup_distance = dedup_distance
+        # Per model: links sent to the tier and answers it got accepted
+        self.tier_requests = Counter()
+        self.tier_hits = Counter()
         self.keys = keys
-        self.links = get_links_for_parsing()
-        self.campaigns = [campaign[1] for campaign in get_campaigns()]
+        self.workers = workers
+        self.limiter = RateLimiter(
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+        )
+        self.links = []
+        self.campaigns = []
         self.attempts = 1
+        self.api = None
+        self.writer = None
+
+    async def load(self):
+        """Fetch the links ready for parsing and the campaigns from the API"""
+        self.api = create_async_client()
+        self.writer = AsyncLinkUpdateBuffer(client=self.api)
+        self.links, campaigns = await asyncio.gather(
+            self.api.get_links_for_parsing(), self.api.get_campaigns()
+        )
+        self.campaigns = [campaign[1] for campaign in campaigns]
+
+    async def close(self):
+        """Send the remaining link updates and close the API client"""
+        self.log_tier_stats()
+        try:
+            await self.writer.aclose()
+        finally:
+            await self.api.aclose()
+            if self.cache:
+                self.cache.close()
+            if self.image_pool:
+                self.image_pool.shutdown()
+
+    async def extract(self, link: str, content: str, keys: list) -> dict:
+        """
+        Ask the model tiers for `keys` until an answer is good enough.
+
+        Every tier gets self.attempts tries at an answer with all the keys.
+        Answers scoring below the tier's min_score are escalated to the next
+        tier, and the best answer is returned if no tier is good enough.
+        """
+        best, best_score = {}, -1.0
+
+        for tier in self.tiers:
+            model = tier["model"]
+            data = {}
+            count = 0
+            self.tier_requests[model] += 1
+
+            while (
+                not has_required_keys(json_obj=data, required_keys=keys)
+                and count < self.attempts
+            ):
+                print(
+                    f"Parsing {link} with {model} [attempt {count+1}/{self.attempts}]"
+                )
 
-    async def content_parser(self, id, link):
-        """Extract content from a given text document"""
-        file_path = f"{self.outfolder}/{link}.txt"
-        print(f"Opening {file_path}")
-        with open(file_path, "r", encoding="utf-8") as file:
-            content = file.read()
+                extra_instructions = ""
+                if count > 0:
+                    extra_instructions = {
+                        "role": "user",
+                        "message": f"REMEMBER to return json object with these key: {keys}",
+                    }
 
-        count = 0
-        data = {}
+                count += 1
 
-        while (
-            not has_required_keys(json_obj=data, required_keys=self.keys)
-            and count < self.attempts
-        ):
-            print(f"Parsing {link} [attempt {count+1}/{self.attempts}]")
+                try:
+                    response = await async_complete_chat(
+                        content,
+                        keys,
+                        self.campaigns,
+                        extra_instructions,
+                        limiter=self.limiter,
+                        model=model,
+                    )
+                    data.update(json.loads(response.choices[0].message.content))
+                except (json.JSONDecodeError, asyncio.TimeoutError) as e:
+                    logging.error(f"Error or timeout for {link}: {e}")
+                    continue  # Skip to the next iteration on error or timeout
+
+            score = score_extraction(data, keys, self.campaigns)
+            if not has_required_keys(json_obj=data, required_keys=keys):
+                score = 0.0
+
+            if score > best_score:
+                best, best_score = data, score
+
+            if score >= tier.get("min_score", 0) and data:
+                self.tier_hits[model] += 1
+                return data
+
+            print(f"Escalating {link}, {model} scored {score:.2f}")
+
+        return best
+
+    def log_tier_stats(self):
+        for tier in self.tiers:
+            model = tier["model"]
+            requests = self.tier_requests[model]
+            hits = self.tier_hits[model]
+            rate = hits / requests if requests else 0
+            logging.info(f"{model}: {hits}/{requests} links accepted ({rate:.0%})")
+
+    async def find_similar_link(
+        self, kind: str, id: int, fingerprint: int, digest: str = None
+    ):
+        """Closest processed link with a similar fingerprint, if any"""
+        try:
+            return await self.api.get_similar_link(
+                kind,
+                fingerprint,
+                max_distance=self.dedup_distance,
+                exclude_id=id,
+                digest=digest,
+            )
+        except Exception as e:
+            logging.error(f"Error looking up similar links: {e}")
+            return None
+
+    async def reuse_text_result(self, id: int, link: str, text: str):
+        """
+        Take what can be taken from an already parsed link with (nearly) the
+        same text.
+
+        A copy of a page gets that page's fields, and a page without an email
+        close to one without an email (parked domains, 'under construction')
+        is marked parsed. A page with an email close to one with an email
+        (sites built from a template) reuses the fields that describe the
+        business, but keeps its own contact details: the email, contact name
+        and pronoun are only reused when both pages have the same email. A 'no
+        email' result is never reused for a page that has one. The page's
+        fingerprint is stored either way.
+
+        :return: None when the page needs no further parsing, otherwise the
+            fields to reuse, keyed like self.keys.
+        """
+        fingerprint, digest = text_hash(text, link), text_digest(text)
+        self.writer.add(id, text_hash=fingerprint, text_digest=digest)
+
+        match = await self.find_similar_link("text", id, fingerprint, digest)
+        if match is None:
+            return {}
+
+        email = find_email(text, link)
+        if match["email"] is None and email is not None:
+            return {}
+
+        if match["text_digest"] == digest:
+            print(f"{link} has the same text as {match['link']}, reusing its result")
+            self.writer.add(
+                id,
+                email=match["email"],
+                contact_name=match["contact_name"],
+                pronoun=match["pronoun"],
+                industry=match["industry"],
+                city=match["city"],
+                area=match["area"],
+                parsed=1,
+            )
+            return None
+
+        if match["email"] is None:
+            print(f"{link} looks like {match['link']}, which has no email, skipping")
+            self.writer.add(id, parsed=1)
+            return None
 
-            extra_instructions = ""
-            if count > 0:
-                extra_instructions = {
-                    "role": "user",
-                    "message": f"REMEMBER to return json object with these key: {self.keys}",
+        columns = {"industry": "industry", "city": "city", "area": "area"}
+        if email == match["email"]:
+            columns.update(
+                {
+                    "e-mail": "email",
+                    "contact_name": "contact_name",
+                    "pronoun": "pronoun",
                 }
+            )
 
-            count += 1
+        print(f"{link} looks like {match['link']}, reusing its fields")
+        return {
+            key: match[column]
+            for key, column in columns.items()
+            if key in self.keys and match[column] is not None
+        }
 
-            try:
-                # Wait for the async function with a timeout
-                response = await asyncio.wait_for(
-                    async_complete_chat(
-                        content, self.keys, self.campaigns, extra_instructions
-                    ),
-                    timeout=20,
-                )
-                data.update(json.loads(response.choices[0].message.content))
-            except (json.JSONDecodeError, asyncio.TimeoutError) as e:
-                logging.error(f"Error or timeout for {link}: {e}")
-                continue  # Skip to the next iteration on error or timeout
+    async def prepare_page(self, id, link):
+        """
+        Read a page and work out what is left to ask the model.
+
+        Returns a page dict with the reduced content, the keys still
+        missing and the fields found by the rules, or None when the page
+        was dealt with without the model.
+        """
+        file_path = f"{self.outfolder}/{link}.txt"
+        print(f"Opening {file_path}")
+        with open(file_path, "r", encoding="utf-8") as file:
+            text = file.read()
+
+        # Fields found by the rules are not asked from the model
+        fields = {}
+        if self.fast_path:
+            fields = extract_fields(text, link, self.keys)
+            if "e-mail" in self.keys and "e-mail" not in fields:
+                # Leads need an email, so the rest of the page is of no use
+                print(f"No email found on {link}, skipping")
+                self.writer.add(id, parsed=1)
+                return None
+
+        if self.dedup_distance is not None:
+            reused = await self.reuse_text_result(id, link, text)
+            if reused is None:
+                return None
+            # The page's own fields win over those of a near-duplicate
+            fields = {**reused, **fields}
+
+        keys = [key for key in self.keys if key not in fields]
+        content = reduce_content(text, max_tokens=self.max_content_tokens)
+
+        page = {
+            "id": id,
+            "link": link,
+            "content": content,
+            "keys": keys,
+            "fields": fields,
+            "cache_key": make_key(
+                "extract",
+                extraction_prompt_version,
+                [tier["model"] for tier in self.tiers],
+                content,
+                keys,
+                self.campaigns,
+            ),
+        }
+
+        cached = None
+        if keys and self.cache:
+            cached = self.cache.get(page["cache_key"])
+        if cached is not None:
+            print(f"Using cached response for {link}")
+            self.save_page(page, json.loads(cached), cache=False)
+            return None
+
+        if not keys:
+            self.save_page(page, {}, cache=False)
+            return None
+
+        return page
+
+    def save_page(self, page: dict, data: dict, cache: bool = True):
+        """Cache the model's answer for a page and queue the link update"""
+        id, link, keys = page["id"], page["link"], page["keys"]
+
+        if (
+            self.cache
+            and cache
+            and keys
+            and has_required_keys(json_obj=data, required_keys=keys)
+        ):
+            self.cache.set(page["cache_key"], json.dumps(data))
+
+        data = {**data, **page["fields"]}
 
         print(f"Updating {link} in database")
         if data:
-            update_link_record(
-                link_id=id,
+            self.writer.add(
+                id,
                 email=data.get("e-mail", ""),
                 contact_name=data.get("contact_name", ""),
                 pronoun=data.get("pronoun", ""),
@@ -160,12 +586,69 @@ class AiParser:
             )
         else:
             logging.warning(f"No data for {link}")
-            update_link_record(link_id=id, parsed=1)
+            self.writer.add(id, parsed=1)
+
+    async def content_parser(self, id, link):
+        """Extract content from a given text document"""
+        page = await self.prepare_page(id, link)
+        if page is None:
+            return
+
+        data = await self.extract(link, page["content"], page["keys"])
+        self.save_page(page, data)
+
+    async def parse_pack(self, pages: list):
+        """
+        Extract several pages with one request to the first tier.
+
+        Answers are matched to the pages by link id. Pages with a missing
+        or implausible answer go through the single page cascade.
+        """
+        if len(pages) == 1:
+            page = pages[0]
+            self.save_page(
+                page, await self.extract(page["link"], page["content"], page["keys"])
+            )
+            return
+
+        tier = self.tiers[0]
+        model = tier["model"]
+        print(f"Parsing {len(pages)} links in one request with {model}")
+
+        answers = {}
+        try:
+            response = await async_complete_packed_chat(
+                pages, self.campaigns, limiter=self.limiter, model=model
+            )
+            answers = json.loads(response.choices[0].message.content)
+        except (json.JSONDecodeError, asyncio.TimeoutError) as e:
+            logging.error(f"Error or timeout for packed request: {e}")
+
+        for page in pages:
+            data = answers.get(str(page["id"])) if isinstance(answers, dict) else None
+            self.tier_requests[model] += 1
+
+            if (
+                isinstance(data, dict)
+                and has_required_keys(json_obj=data, required_keys=page["keys"])
+                and score_extraction(data, page["keys"], self.campaigns)
+                >= tier.get("min_score", 0)
+            ):
+                self.tier_hits[model] += 1
+                self.save_page(page, data)
+                continue
+
+            print(f"No usable packed answer for {page['link']}, parsing it alone")
+            try:
+                data = await self.extract(page["link"], page["content"], page["keys"])
+                self.save_page(page, data)
+            except Exception as e:
+                logging.error(f"Error parsing content: {e}")
 
     # TODO After classification, maybe parse the text content?
     async def image_classification(self, id: int, link: str):
         """Classify a image and return a json object"""
-        print("Classifying image")
+        print(f"Classifying image of {link}")
         count = 0
         data = {}
 
@@ -183,13 +666,28 @@ class AiParser:
         }
 
         # Path to your image
-        image_path = f"{self.outfolder}/{link}.png"
+        image_path = screenshot_path(self.outfolder, link)
 
         if not os.path.exists(image_path):
-            raise Exception(f"No image found: {image_path}")
-
-        # Getting the base64 string
-        base64_image = encode_image(image_path)
+            # Pages fetched over plain HTTP get no screenshot unless they
+            # have an email (see fetcher.needs_browser), parse their text
+            print(f"No screenshot of {link}, parsing its text instead")
+            await self.content_parser(id=id, link=link)
+            return
+
+        # Shrink the screenshot off the event loop before encoding it
+        if self.image_pool is None:
+            self.image_pool = ProcessPoolExecutor(max_workers=self.image_workers)
+        loop = asyncio.get_running_loop()
+        image, (width, height) = await loop.run_in_executor(
+            self.image_pool,
+            prepare_screenshot,
+            image_path,
+            self.image_width,
+            self.image_max_height,
+            self.image_quality,
+        )
+        base64_image = base64.b64encode(image).decode("utf-8")
 
         user_message = {
             "role": "user",
@@ -201,24 +699,44 @@ class AiParser:
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": f"data:image/png;base64,{base64_image}",
-                        "detail": "high",
+                        "url": f"data:image/jpeg;base64,{base64_image}",
+                        "detail": self.image_detail,
                     },
                 },
             ],
         }
 
+        cache_key = make_key(
+            "classify",
+            classification_prompt_version,
+            classification_model,
+            self.image_detail,
+            base64_image,
+        )
+        cached = self.cache.get(cache_key) if self.cache else None
+        if cached is not None:
+            print(f"Using cached classification for {link}")
+            data = json.loads(cached)
+        elif self.dedup_distance is not None:
+            fingerprint = await loop.run_in_executor(
+                self.image_pool, image_hash, image_path
+            )
+            self.writer.add(id, image_hash=fingerprint)
+            match = await self.find_similar_link("image", id, fingerprint)
+            if match:
+                print(f"{link} looks like {match['link']}, reusing its classification")
+                data = {"classification": match["classification"]}
+
         while (
-            not has_required_keys(json_obj=data, required_keys="classification")
+            not has_required_keys(json_obj=data, required_keys=["classification"])
             and count < self.attempts
         ):
-            response = await asyncio.wait_for(
-                client.chat.completions.create(
-                    model="gpt-4-vision-preview",
-                    messages=[system_message, user_message],
-                    max_tokens=500,
-                ),
-                timeout=20,
+            response = await create_completion(
+                limiter=self.limiter,
+                tokens=estimate_image_tokens(width, height, self.image_detail) + 500,
+                model=classification_model,
+                messages=[system_message, user_message],
+                max_tokens=500,
             )
 
             # Extracting the message content
@@ -234,30 +752,133 @@ class AiParser:
 
             print(f"Data: {data}")
 
-            classification = data.get("classification", 0)
-            print(f"Updating link with classification: {classification}")
-            # Update link return with the classification
-            update_link_record(link_id=id, classification=classification)
+            count += 1
 
-            if classification <= 6:
-                print("Classification less than 6, initializing content parser")
-                await self.content_parser(id=id, link=link)
+        if (
+            self.cache
+            and cached is None
+            and has_required_keys(json_obj=data, required_keys=["classification"])
+        ):
+            self.cache.set(cache_key, json.dumps(data))
 
-            count += 1
+        classification = data.get("classification", 0)
+        print(f"Updating link with classification: {classification}")
+        # Update link return with the classification
+        self.writer.add(id, classification=classification)
 
-    async def run(self, image_classification: bool = False):
-        print("Starting AI parser...")
-        print(f"There are {len(self.links)} links")
-        for id, link in self.links:
-            print(f"Parsing {link}")
-            if image_classification:
+        if classification <= 6:
+            print("Classification less than 6, initializing content parser")
+            await self.content_parser(id=id, link=link)
+
+    async def parse_links(self, stop: asyncio.Event, image_classification=False):
+        """Worker: parse links from self.queue until it is empty or stop is set"""
+        # Prepared page that didn't fit the last pack, it starts the next one
+        carried = None
+
+        while not stop.is_set():
+            if carried is not None:
+                id, link = carried["id"], carried["link"]
+            else:
                 try:
+                    id, link = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+
+            print(f"Parsing {link}")
+            page, carried = carried, None
+            try:
+                if image_classification:
                     await self.image_classification(id=id, link=link)
+                elif self.pack_tokens:
+                    carried = await self.parse_packed_links(id, link, page)
+                else:
+                    await self.content_parser(id=id, link=link)
+            except Exception as e:
+                logging.error(f"Error parsing content: {e}")
+
+        if carried is not None:
+            self.queue.put_nowait((carried["id"], carried["link"]))
+
+    async def parse_packed_links(self, id, link, page=None):
+        """
+        Fill a pack of pages, starting with the given link, and parse it.
+
+        Pages are taken from self.queue while their content fits in
+        self.pack_tokens. A page over the budget on its own is parsed alone.
+
+        :param page: The link prepared already, when it was carried over
+            from the previous pack.
+        :return: The prepared page that didn't fit, to start the next pack
+            with, or None.
+        """
+        pack, size = [], 0
+
+        while True:
+            if page is None:
+                try:
+                    page = await self.prepare_page(id, link)
                 except Exception as e:
-                    logging.error(f"Error trying to parse image: {e}")
+                    logging.error(f"Error reading {link}: {e}")
+
+            if page is not None:
+                tokens = estimate_tokens(page["content"])
+                if pack and size + tokens > self.pack_tokens:
+                    break
+                pack.append(page)
+                size += tokens
+                page = None
+                if size >= self.pack_tokens:
+                    break
+
+            try:
+                id, link = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
                 break
+
+        if pack:
+            await self.parse_pack(pack)
+
+        return page
+
+    async def run(self, image_classification: bool = False):
+        print("Starting AI parser...")
+        await self.load()
+        print(f"There are {len(self.links)} links")
+
+        self.queue = asyncio.Queue()
+        for record in self.links:
+            self.queue.put_nowait(tuple(record))
+
+        # First Ctrl-C lets the in-flight links finish, the second aborts them
+        stop = asyncio.Event()
+        workers = [
+            asyncio.create_task(self.parse_links(stop, image_classification))
+            for _ in range(self.workers)
+        ]
+
+        def interrupt():
+            if stop.is_set():
+                print("Aborting in-flight links")
+                for worker in workers:
+                    worker.cancel()
             else:
-                try:
-                    await self.content_parser(id=id, link=link)
-                except Exception as e:
-                    logging.error(f"Error parsing content: {e}")
+                print("Finishing in-flight links, press Ctrl-C again to abort")
+                stop.set()
+
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGINT, interrupt)
+        except (NotImplementedError, RuntimeError):
+            # Not supported on Windows, Ctrl-C then aborts right away
+            pass
+
+        try:
+            await asyncio.gather(*workers, return_exceptions=True)
+        finally:
+            try:
+                loop.remove_signal_handler(signal.SIGINT)
+            except (NotImplementedError, RuntimeError):
+                pass
+            await self.close()
+
+        print(f"Done, {self.queue.qsize()} links left for the next run")
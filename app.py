@@ -1,3 +1,5 @@
+import os
+
 from flask import (
     Flask,
     render_template,
@@ -8,12 +10,19 @@ from flask import (
     Response,
     flash,
     session,
+    stream_with_context,
 )
 
 from database import (
-    db_get_lead,
+    db_claim_lead,
+    db_release_leads,
     db_get_leads,
-    db_get_all_leads,
+    db_iter_leads,
+    db_iter_all_leads,
+    db_get_max_lead_seq,
+    db_get_max_completed_seq,
+    db_get_export_watermark,
+    db_set_export_watermark,
     db_delete_all_leads,
     db_create_lead,
     db_create_sent,
@@ -22,22 +31,21 @@ from database import (
     db_get_campaign,
     db_get_campaigns,
     db_delete_leads,
-    db_get_lead_count_from_campaign,
     db_get_one_lead,
+    db_get_dashboard_stats,
     db_update_lead,
-    db_get_lead_count_remainder,
-    db_get_lead_count,
-    db_get_unparsed_links,
-    db_get_unscraped_links,
     db_verify_password,
     db_create_worklog,
     db_get_user,
     db_get_worklogs,
+    release_connection,
 )
 
+from migrations import run_migrations
+
 from schema import Link
 
-from utils import generate_csv
+from utils import iter_csv, gzip_chunks, screenshot_path
 
 from routes import routes_blueprint
 
@@ -49,6 +57,12 @@ app.register_blueprint(routes_blueprint, url_prefix="/api")
 
 app.secret_key = "1234"
 
+# Bring the schema up to date before serving requests
+run_migrations()
+
+# Hand the per-request database connection back after every request
+app.teardown_appcontext(release_connection)
+
 
 # TODO Deleting a link should also delete associated content
 # TODO List of all leads with options to edit each field
@@ -66,11 +80,10 @@ app.secret_key = "1234"
 # TODO Categories links when parsing?
 # TODO Make it possible to send a list of links instead of one at a time
 # TODO Make a function to export all pre-leads, just remove the ones with "none" fields.
-# TODO Normalize data None vs none
 
 
-def get_lead():
-    lead: Link = db_get_lead()
+def get_lead(user_id):
+    lead: Link = db_claim_lead(user_id=user_id)
 
     if not lead:
         return None
@@ -84,7 +97,7 @@ def get_lead():
         "industry": lead.industry,
         "city": lead.city,
         "area": lead.area,
-        "screenshot": f"content/{lead.link}.png",
+        "screenshot": os.path.basename(screenshot_path(app.static_folder, lead.link)),
     }
 
     return context
@@ -104,26 +117,23 @@ def home():
         {"id": campaign[0], "name": campaign[1]} for campaign in existing_campaigns
     ]
 
-    total_unscraped_links = db_get_unscraped_links()
-    total_unparsed_links = db_get_unparsed_links()
-    total_leads = db_get_lead_count()
-    remaining_leads = db_get_lead_count_remainder()
+    stats = db_get_dashboard_stats()
 
     context = {
         "campaigns": campaigns,
-        "total_unscraped_links": total_unscraped_links,
-        "total_unparsed_links": len(total_unparsed_links),
-        "remaining_leads": remaining_leads,
-        "total_leads": total_leads,
+        "total_unscraped_links": stats["total_unscraped_links"],
+        "total_unparsed_links": stats["total_unparsed_links"],
+        "remaining_leads": stats["remaining_leads"],
+        "total_leads": stats["total_leads"],
     }
 
     return render_template("campaigns.html", **context)
 
 
-def get_campaign_context(campaign):
+def get_campaign_context(campaign, user_id):
     campaign_id, campaign_name, _ = campaign
 
-    context = get_lead()
+    context = get_lead(user_id=user_id)
 
     if not context:
         return None
@@ -135,9 +145,11 @@ def get_campaign_context(campaign):
         if campaign[0] != campaign_id
     ]
 
+    stats = db_get_dashboard_stats()
+
     context["campaign"] = campaign_name
-    context["campaign_count"] = db_get_lead_count_from_campaign(campaign_id=campaign_id)
-    context["remaining_leads"] = db_get_lead_count_remainder()
+    context["campaign_count"] = stats["campaign_counts"].get(campaign_id, 0)
+    context["remaining_leads"] = stats["remaining_leads"]
     context["campaign_id"] = campaign_id
     context["campaigns"] = campaigns
 
@@ -157,7 +169,7 @@ def campaign(campaign_name):
 
     campaign_id = campaign[0]
 
-    context = get_campaign_context(campaign=campaign)
+    context = get_campaign_context(campaign=campaign, user_id=user_id)
 
     if not context:
         return render_template("no_leads.html", campaign_id=campaign_id)
@@ -193,7 +205,7 @@ def campaign(campaign_name):
         print(f"Adding worklog: {user_id}, {domain}")
         db_create_worklog(user_id=user_id, domain=domain)
 
-        context = get_campaign_context(campaign=campaign)
+        context = get_campaign_context(campaign=campaign, user_id=user_id)
 
         # Check if context is None
         if context is not None:
@@ -293,28 +305,108 @@ def worklog():
     return render_template("worklogs.html", **context)
 
 
+def csv_response(batches, columns, filename="export.csv", headers=None):
+    """
+    Stream batches of rows as a CSV download.
+
+    Pass ?gzip=1 to compress the stream with Content-Encoding: gzip.
+    """
+    chunks = iter_csv(batches, columns)
+    headers = {
+        "Content-disposition": f"attachment; filename={filename}",
+        **(headers or {}),
+    }
+
+    if request.args.get("gzip"):
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+
+    return Response(
+        stream_with_context(chunks),
+        mimetype="text/csv",
+        headers=headers,
+    )
+
+
+def get_export_window(watermark_name, get_high_mark):
+    """
+    Work out which ids an export covers from the request arguments.
+
+    ?delta=1 exports everything added since the watermark stored for this
+    export and moves the watermark once the download completes. ?since=<id>
+    exports everything after the given id without touching the stored
+    watermark. Without either, everything is exported.
+
+    :param get_high_mark: Returns the highest id the export can include now.
+    :return: Tuple of (since_id, until_id, record), where record tells if
+        the watermark should be stored after the export.
+    """
+    since = request.args.get("since", type=int)
+    delta = bool(request.args.get("delta"))
+
+    if since is None and not delta:
+        return 0, None, False
+
+    if since is None:
+        since = db_get_export_watermark(name=watermark_name)
+
+    # Fix the upper bound up front, rows added during the download belong
+    # to the next export
+    until = max(get_high_mark(), since)
+
+    return since, until, delta
+
+
+def record_watermark(batches, watermark_name, last_id):
+    yield from batches
+    # Only move the watermark once every row has been handed to the client
+    db_set_export_watermark(name=watermark_name, last_id=last_id)
+
+
+def export_response(batches, columns, watermark_name, since_id, until_id, record):
+    headers = {}
+    if until_id is not None:
+        headers["X-Export-Since"] = str(since_id)
+        headers["X-Export-Watermark"] = str(until_id)
+    if record:
+        batches = record_watermark(batches, watermark_name, until_id)
+    return csv_response(batches, columns, headers=headers)
+
+
 @app.route("/download-csv/<campaign_id>")
 def download_csv(campaign_id):
     # TODO Check for sent
-    leads = db_get_leads(campaign_id)
-    csv_content = generate_csv(
-        leads, ["id", "email", "name", "domain", "pronoun", "area"]
+    watermark_name = f"campaign:{campaign_id}"
+    since_id, until_id, record = get_export_window(
+        watermark_name, lambda: db_get_max_lead_seq(campaign_id=campaign_id)
     )
-    return Response(
-        csv_content,
-        mimetype="text/csv",
-        headers={"Content-disposition": "attachment; filename=export.csv"},
+    leads = db_iter_leads(campaign_id, since_seq=since_id, until_seq=until_id)
+    return export_response(
+        leads,
+        ["id", "email", "name", "domain", "pronoun", "area"],
+        watermark_name,
+        since_id,
+        until_id,
+        record,
     )
 
 
 @app.route("/dump-all", methods=["GET"])
 def dump_all():
-    leads = db_get_all_leads()
-    csv_content = generate_csv(leads, ["domain", "email", "name", "pronoun", "area"])
-    return Response(
-        csv_content,
-        mimetype="text/csv",
-        headers={"Content-disposition": "attachment; filename=export.csv"},
+    watermark_name = "all"
+    # The watermark is a completion sequence, links complete after they are
+    # added and would be missed by an id watermark
+    since_id, until_id, record = get_export_window(
+        watermark_name, db_get_max_completed_seq
+    )
+    leads = db_iter_all_leads(since_seq=since_id, until_seq=until_id)
+    return export_response(
+        leads,
+        ["domain", "email", "name", "pronoun", "area"],
+        watermark_name,
+        since_id,
+        until_id,
+        record,
     )
 
 
@@ -371,7 +463,11 @@ def login():
 @app.route("/logout")
 @login_required
 def logout():
-    session.pop("username", None)
+    username = session.pop("username", None)
+    user = db_get_user(username=username)
+    if user:
+        # Hand any lead the reviewer was looking at to the next reviewer
+        db_release_leads(user_id=user[0])
     return redirect(url_for("login"))
 
 
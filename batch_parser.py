@@ -0,0 +1,260 @@
+import os
+import json
+import shutil
+import asyncio
+import logging
+
+import httpx
+
+from ai_parser import (
+    AiParser,
+    client,
+    system_message,
+    get_user_message,
+    has_required_keys,
+    score_extraction,
+)
+
+# Limits of a single OpenAI batch job
+max_batch_requests = 50000
+completion_window = "24h"
+
+# Batch states after which the job won't change anymore
+FINISHED_STATES = {"completed", "failed", "expired", "cancelled"}
+
+
+class OpenAIBatchBackend:
+    """
+    Runs batch jobs through the OpenAI batch API.
+
+    The openai package is locked at a version without client.batches, so
+    the endpoints are called through the client's generic post/get.
+    """
+
+    def __init__(self, client=client):
+        self.client = client
+
+    async def submit(self, path: str) -> str:
+        with open(path, "rb") as file:
+            uploaded = await self.client.files.create(
+                file=(os.path.basename(path), file.read()), purpose="batch"
+            )
+
+        response = await self.client.post(
+            "/batches",
+            cast_to=httpx.Response,
+            body={
+                "input_file_id": uploaded.id,
+                "endpoint": "/v1/chat/completions",
+                "completion_window": completion_window,
+            },
+        )
+        return response.json()["id"]
+
+    async def status(self, batch_id: str):
+        """Return the state of a job and the id of its output file"""
+        response = await self.client.get(f"/batches/{batch_id}", cast_to=httpx.Response)
+        batch = response.json()
+        return batch["status"], batch.get("output_file_id")
+
+    async def download(self, output_id: str, path: str):
+        content = await self.client.files.content(output_id)
+        with open(path, "wb") as file:
+            file.write(content.content)
+
+
+class LocalBatchBackend:
+    """
+    File based stand-in for the batch API, for trying out batch runs.
+
+    Jobs complete on the first status check. Every request is answered by
+    `respond`, which gets the request body and returns the message content.
+    """
+
+    def __init__(self, folder: str, respond=None):
+        self.folder = folder
+        self.respond = respond or (lambda body: "{}")
+        os.makedirs(folder, exist_ok=True)
+
+    async def submit(self, path: str) -> str:
+        batch_id = f"local_{len(os.listdir(self.folder))}"
+        shutil.copy(path, os.path.join(self.folder, f"{batch_id}.input.jsonl"))
+        return batch_id
+
+    async def status(self, batch_id: str):
+        input_path = os.path.join(self.folder, f"{batch_id}.input.jsonl")
+        output_path = os.path.join(self.folder, f"{batch_id}.output.jsonl")
+
+        if not os.path.exists(output_path):
+            with open(input_path, encoding="utf-8") as infile, open(
+                output_path, "w", encoding="utf-8"
+            ) as outfile:
+                for line in infile:
+                    request = json.loads(line)
+                    content = self.respond(request["body"])
+                    result = {
+                        "custom_id": request["custom_id"],
+                        "response": {
+                            "status_code": 200,
+                            "body": {"choices": [{"message": {"content": content}}]},
+                        },
+                        "error": None,
+                    }
+                    outfile.write(json.dumps(result) + "\n")
+
+        return "completed", output_path
+
+    async def download(self, output_id: str, path: str):
+        shutil.copy(output_id, path)
+
+
+def create_backend(config: dict):
+    """Create the backend named in the batch section of config.json"""
+    if config.get("backend", "openai") == "local":
+        return LocalBatchBackend(folder=os.path.join(config["folder"], "local"))
+    return OpenAIBatchBackend()
+
+
+class BatchParser(AiParser):
+    """
+    AiParser that runs the extraction as an offline batch job.
+
+    The prompts of all links ready for parsing are written to a JSONL file
+    in the batch format, submitted to the backend and polled until done,
+    and the results are saved through the update buffer in bulk. The job is
+    kept in `folder`, so an interrupted run picks up the same job again.
+    """
+
+    def __init__(
+        self, *args, backend=None, folder="batches", poll_interval=60, **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.backend = backend or OpenAIBatchBackend()
+        self.folder = folder
+        self.poll_interval = poll_interval
+        self.state_path = os.path.join(folder, "job.json")
+        os.makedirs(folder, exist_ok=True)
+
+    async def write_requests(self, path: str) -> dict:
+        """Write the batch requests, return the pages they are for by link id"""
+        model = self.tiers[0]["model"]
+        pages = {}
+
+        with open(path, "w", encoding="utf-8") as file:
+            for id, link in self.links:
+                if len(pages) >= max_batch_requests:
+                    print("Batch is full, the remaining links are left for later")
+                    break
+
+                try:
+                    page = await self.prepare_page(id, link)
+                except Exception as e:
+                    logging.error(f"Error reading {link}: {e}")
+                    continue
+
+                if page is None:
+                    continue
+
+                request = {
+                    "custom_id": str(id),
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": model,
+                        "response_format": {"type": "json_object"},
+                        "messages": [
+                            system_message,
+                            get_user_message(
+                                page["content"], page["keys"], self.campaigns
+                            ),
+                        ],
+                    },
+                }
+                file.write(json.dumps(request, ensure_ascii=False) + "\n")
+                # The content is in the request file, the job only needs the rest
+                del page["content"]
+                pages[str(id)] = page
+
+        return pages
+
+    def ingest(self, path: str, pages: dict):
+        """Save the answers in a result file, links without one stay unparsed"""
+        model = self.tiers[0]["model"]
+        min_score = self.tiers[0].get("min_score", 0)
+        saved = 0
+
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                result = json.loads(line)
+                page = pages.get(result["custom_id"])
+                if page is None:
+                    continue
+
+                self.tier_requests[model] += 1
+                response = result.get("response") or {}
+                if result.get("error") or response.get("status_code") != 200:
+                    logging.error(f"Batch request for {page['link']} failed: {result}")
+                    continue
+
+                try:
+                    content = response["body"]["choices"][0]["message"]["content"]
+                    data = json.loads(content)
+                except (KeyError, IndexError, TypeError, json.JSONDecodeError) as e:
+                    logging.error(f"Unreadable batch answer for {page['link']}: {e}")
+                    continue
+
+                if not (
+                    isinstance(data, dict)
+                    and has_required_keys(json_obj=data, required_keys=page["keys"])
+                    and score_extraction(data, page["keys"], self.campaigns)
+                    >= min_score
+                ):
+                    logging.warning(f"No usable batch answer for {page['link']}")
+                    continue
+
+                self.tier_hits[model] += 1
+                self.save_page(page, data)
+                saved += 1
+
+        print(f"Saved {saved} of {len(pages)} links from the batch")
+
+    async def run(self):
+        print("Starting AI batch parser...")
+        await self.load()
+
+        try:
+            if os.path.exists(self.state_path):
+                with open(self.state_path, encoding="utf-8") as file:
+                    state = json.load(file)
+                print(f"Resuming batch {state['batch_id']}")
+            else:
+                print(f"There are {len(self.links)} links")
+                requests_path = os.path.join(self.folder, "requests.jsonl")
+                pages = await self.write_requests(requests_path)
+                if not pages:
+                    print("Nothing to send")
+                    return
+
+                batch_id = await self.backend.submit(requests_path)
+                state = {"batch_id": batch_id, "pages": pages}
+                with open(self.state_path, "w", encoding="utf-8") as file:
+                    json.dump(state, file)
+                print(f"Submitted batch {batch_id} with {len(pages)} links")
+
+            while True:
+                status, output_id = await self.backend.status(state["batch_id"])
+                if status in FINISHED_STATES:
+                    break
+                print(f"Batch is {status}, checking again in {self.poll_interval}s")
+                await asyncio.sleep(self.poll_interval)
+
+            if output_id:
+                results_path = os.path.join(self.folder, "results.jsonl")
+                await self.backend.download(output_id, results_path)
+                self.ingest(results_path, state["pages"])
+            else:
+                print(f"Batch {status} without results")
+
+            os.remove(self.state_path)
+        finally:
+            await self.close()
@@ -4,9 +4,12 @@ import asyncio
 
 from driver import get_content_from_url
 
-from database import tables, check_table_exists
+from migrations import run_migrations
+from database import db_rebuild_stats
 from sheets import parse_sheet_save_url, add_sent
 from ai_parser import AiParser
+from batch_parser import BatchParser, create_backend
+from llm_cache import ResponseCache
 from services import get_links, create_user
 
 # Configure logging
@@ -20,26 +23,26 @@ logging.basicConfig(
 
 
 async def main(config):
-    # Create tables is they don't exists
-    for key in tables:
-        if not check_table_exists(key):
-            print(f"Creating table: {key}")
-            tables[key]()
+    # Create tables and bring the schema up to date
+    run_migrations()
 
     while True:
         print(
             """
     Type a to get links from google sheet
-    Type b to scrape content from links (Will open Chrome)
+    Type b to scrape content from links (Will open Firefox)
     Type c to extract info from content using ChatGPT
     Type d to add user
     Type e to add 'sent'
+    Type f to rebuild dashboard statistics
+    Type g to extract info from content as an offline batch job
+    Type h to classify website screenshots using ChatGPT
     Type x to exit
     """
         )
 
         action = input()
-        actions = ["a", "b", "c", "d", "x"]
+        actions = ["a", "b", "c", "d", "e", "f", "g", "h", "x"]
         if action in actions:
             break
 
@@ -53,14 +56,49 @@ async def main(config):
 
     if action == "b":
         links = get_links()
-        get_content_from_url(links=links, outfolder=config["out_files_folder"])
+        get_content_from_url(
+            links=links,
+            outfolder=config["out_files_folder"],
+            **config.get("scraper", {}),
+        )
 
-    if action == "c":
-        parser = AiParser(
-            outfolder=config["out_files_folder"], keys=config["aiparser"]["keys"]
+    if action in ("c", "g", "h"):
+        cache_config = config["aiparser"].get("cache")
+        cache = ResponseCache(**cache_config) if cache_config else None
+
+        parser_config = dict(
+            outfolder=config["out_files_folder"],
+            keys=config["aiparser"]["keys"],
+            workers=config["aiparser"].get("workers", 1),
+            requests_per_minute=config["aiparser"].get("requests_per_minute", 500),
+            tokens_per_minute=config["aiparser"].get("tokens_per_minute", 60000),
+            cache=cache,
+            max_content_tokens=config["aiparser"].get("max_content_tokens"),
+            fast_path=config["aiparser"].get("fast_path", True),
+            extraction_tiers=config["aiparser"].get("extraction_tiers"),
+            pack_tokens=config["aiparser"].get("pack_tokens"),
+            dedup_distance=config["aiparser"].get("dedup_distance"),
+            **config["aiparser"].get("screenshots", {}),
         )
+
+    if action == "c":
+        parser = AiParser(**parser_config)
         await parser.run(image_classification=False)
 
+    if action == "g":
+        batch_config = config["aiparser"]["batch"]
+        parser = BatchParser(
+            backend=create_backend(batch_config),
+            folder=batch_config["folder"],
+            poll_interval=batch_config.get("poll_interval", 60),
+            **parser_config,
+        )
+        await parser.run()
+
+    if action == "h":
+        parser = AiParser(**parser_config)
+        await parser.run(image_classification=True)
+
     if action == "d":
         print("Name: ")
         username = input()
@@ -75,6 +113,10 @@ async def main(config):
     if action == "e":
         add_sent(spread_sheet_id=config["google_sheets"]["sheet_id"], sheet_name="sent")
 
+    if action == "f":
+        print("Rebuilding dashboard statistics")
+        db_rebuild_stats()
+
     if action == "x":
         pass
 
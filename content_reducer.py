@@ -0,0 +1,103 @@
+import re
+
+from utils import estimate_tokens
+
+EMAIL_PATTERN = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+# Danish phone numbers: 8 digits, optionally grouped and prefixed with +45
+PHONE_PATTERN = re.compile(r"(?:\+45[\s-]?)?\b\d{2}(?:[\s-]?\d{2}){3}\b")
+# Postcode followed by a city, e.g. '8000 Aarhus C'
+POSTCODE_PATTERN = re.compile(r"\b\d{4}\s+[A-ZÆØÅ][\wæøåÆØÅ-]+")
+KEYWORD_PATTERN = re.compile(
+    r"kontakt|om os|about|adresse|address|telefon|tlf|e-?mail|cvr|ejer|indehaver|"
+    r"v/|aps\b|a/s\b",
+    re.IGNORECASE,
+)
+COOKIE_PATTERN = re.compile(
+    r"cookie|samtykke|consent|privatlivspolitik|privacy policy|persondata|"
+    r"accepter alle|afvis alle|tillad alle|nødvendige cookies",
+    re.IGNORECASE,
+)
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def is_key_line(line: str) -> bool:
+    """Does the line hold contact details or introduce them?"""
+    return bool(
+        EMAIL_PATTERN.search(line)
+        or PHONE_PATTERN.search(line)
+        or POSTCODE_PATTERN.search(line)
+        or KEYWORD_PATTERN.search(line)
+    )
+
+
+def compact_lines(text: str) -> list:
+    """
+    Split page text into cleaned lines.
+
+    Whitespace is collapsed, and empty lines, repeated lines (menus and
+    footers show up more than once) and cookie banner lines without
+    contact details are dropped.
+    """
+    lines = []
+    seen = set()
+
+    for line in text.splitlines():
+        line = WHITESPACE_PATTERN.sub(" ", line).strip()
+        if not line:
+            continue
+
+        normalized = line.lower()
+        if normalized in seen:
+            continue
+        seen.add(normalized)
+
+        if COOKIE_PATTERN.search(line) and not is_key_line(line):
+            continue
+
+        lines.append(line)
+
+    return lines
+
+
+def reduce_content(text: str, max_tokens: int = None, window: int = 3) -> str:
+    """
+    Compact page text and fit it into a token budget.
+
+    When the compacted text is over `max_tokens`, lines with contact details
+    (emails, phone numbers, addresses, 'kontakt'/'om os' sections) are kept
+    first together with `window` lines on either side, then the page is
+    filled up from the top. The kept lines stay in page order.
+
+    :param text: Text scraped from a page.
+    :param max_tokens: Token budget, None to only compact.
+    :param window: Lines of context kept around each key line.
+    """
+    lines = compact_lines(text)
+    costs = [estimate_tokens(line) for line in lines]
+
+    if max_tokens is None or sum(costs) <= max_tokens:
+        return "\n".join(lines)
+
+    key_indexes = [i for i, line in enumerate(lines) if is_key_line(line)]
+
+    # Key lines themselves, then their context from nearest to farthest,
+    # then the rest of the page from the top
+    order = list(key_indexes)
+    for distance in range(1, window + 1):
+        for i in key_indexes:
+            order.extend((i - distance, i + distance))
+    order.extend(range(len(lines)))
+
+    kept = set()
+    budget = max_tokens
+    for i in order:
+        if i < 0 or i >= len(lines) or i in kept:
+            continue
+        if costs[i] > budget:
+            continue
+        kept.add(i)
+        budget -= costs[i]
+        if budget <= 0:
+            break
+
+    return "\n".join(lines[i] for i in sorted(kept))
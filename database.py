@@ -1,32 +1,131 @@
 import os
 import sqlite3
 import functools
+import itertools
 import logging
+import threading
+import time
 from typing import Optional
 
 import bcrypt
 
 from dotenv import load_dotenv
+from flask import g, has_app_context
 
 from schema import Link
+from utils import (
+    normalize_link_fields,
+    chunked,
+    fingerprint_bands,
+    hamming_distance,
+    FINGERPRINT_BANDS,
+)
 
 load_dotenv()
 
 db_name = os.getenv("DB_NAME")
 
+# Tuning applied to every connection. cache_size is negative, i.e. in KiB.
+db_cache_size = int(os.getenv("DB_CACHE_SIZE", "-65536"))
+db_mmap_size = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+db_busy_timeout = float(os.getenv("DB_BUSY_TIMEOUT", "10"))
+
+# Stay well below SQLite's limit on the number of ? in a statement
+max_query_params = 500
+
+# How long a reviewer holds a lead before it goes back into the queue
+review_lease_seconds = int(os.getenv("REVIEW_LEASE_SECONDS", "600"))
+
+_local = threading.local()
+
+
+def open_connection():
+    """Open a new connection to the database with WAL and tuned pragmas."""
+    conn = sqlite3.connect(db_name, timeout=db_busy_timeout)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size={db_cache_size}")
+    conn.execute(f"PRAGMA mmap_size={db_mmap_size}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def get_connection():
+    """
+    Return the connection for the current context.
+
+    Inside a Flask request the connection is stored on `g`, so every db_*
+    call made while handling the request shares it. Otherwise each thread
+    keeps one long-lived connection. The process id is checked so a
+    connection opened before a gunicorn fork is never shared with a worker.
+    """
+    if has_app_context() and "db" in g:
+        return g.db
+
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.pid != os.getpid():
+        conn = open_connection()
+        _local.conn = conn
+        _local.pid = os.getpid()
+
+    if has_app_context():
+        g.db = conn
+
+    return conn
+
+
+def release_connection(exception=None):
+    """
+    Detach the connection from the current Flask request.
+
+    Registered with `app.teardown_appcontext`. The connection itself stays
+    open for the next request served by this thread; any transaction left
+    open by a failed request is rolled back.
+    """
+    conn = g.pop("db", None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+
+def close_connection():
+    """Close the connection kept by the current thread, if any."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+def iter_rows(query, params=(), batch_size=1000):
+    """
+    Yield the rows of a read-only query in batches of `batch_size`.
+
+    Generators run after the call has returned, so they can't use the
+    connection decorator; this takes the connection for the current
+    request/thread directly and only ever reads from it.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+
 
 def connection(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        print(f"Connection to: {db_name}")
-        # If a connection is already provided, use it.
+        # If a connection is already provided, use it and leave the
+        # transaction to the caller.
         conn = kwargs.pop("conn", None)
 
-        # Determine whether the decorator should manage the connection.
-        manage_conn = False
-        if conn is None:
-            conn = sqlite3.connect(db_name)
-            manage_conn = True
+        manage_conn = conn is None
+        if manage_conn:
+            conn = get_connection()
 
         cursor = conn.cursor()
 
@@ -35,13 +134,16 @@ def connection(func):
             result = func(*args, conn=conn, cursor=cursor, **kwargs)
 
             # Commit the transaction.
-            conn.commit()
+            if manage_conn:
+                conn.commit()
 
             return result
+        except BaseException:
+            if manage_conn and conn.in_transaction:
+                conn.rollback()
+            raise
         finally:
-            # Close the connection if it was opened by the decorator.
-            if manage_conn:
-                conn.close()
+            cursor.close()
 
     return wrapper
 
@@ -194,6 +296,43 @@ def db_create_link(link: str, conn=None, cursor=None):
         logging.error(f"Error adding link {link}: {e}")
 
 
+@connection
+def db_create_links_bulk(links, batch_size=5000, conn=None, cursor=None) -> dict:
+    """
+    Insert many links in one transaction.
+
+    Links repeated in the input or already in the 'link' table count as
+    duplicates, links whose domain is in the 'sent' table are skipped.
+
+    :param links: Iterable of links. It is consumed in chunks, so a streamed
+        request body never has to be held in memory as a whole.
+    :return: Dictionary with the 'inserted', 'duplicate' and 'sent' counts.
+    """
+    counts = {"inserted": 0, "duplicate": 0, "sent": 0}
+    seen = set()
+
+    for chunk in chunked(links, batch_size):
+        new_links = []
+        for link in chunk:
+            if link in seen:
+                counts["duplicate"] += 1
+                continue
+            seen.add(link)
+            new_links.append(link)
+
+        sent = _get_sent_values(cursor, "domain", new_links)
+        rows = [(link,) for link in new_links if link not in sent]
+
+        cursor.executemany("INSERT OR IGNORE INTO link (link) VALUES (?)", rows)
+
+        counts["inserted"] += cursor.rowcount
+        counts["duplicate"] += len(rows) - cursor.rowcount
+        counts["sent"] += len(sent)
+
+    logging.info(f"Bulk link insert: {counts}")
+    return counts
+
+
 @connection
 def db_create_sent(domain: str, email: str = None, conn=None, cursor=None):
     """
@@ -215,6 +354,27 @@ def db_create_sent(domain: str, email: str = None, conn=None, cursor=None):
         print(f"An error occurred: {e}")
 
 
+@connection
+def db_create_sent_bulk(domains, batch_size=5000, conn=None, cursor=None) -> dict:
+    """
+    Insert many domains into the 'sent' table in one transaction, like
+    db_create_sent without an email.
+
+    :param domains: Iterable of domains, consumed in chunks.
+    :return: Dictionary with the 'inserted' and 'duplicate' counts.
+    """
+    counts = {"inserted": 0, "duplicate": 0}
+
+    for chunk in chunked(domains, batch_size):
+        rows = [(domain,) for domain in chunk]
+        cursor.executemany("INSERT OR IGNORE INTO sent (domain) VALUES (?)", rows)
+        counts["inserted"] += cursor.rowcount
+        counts["duplicate"] += len(rows) - cursor.rowcount
+
+    logging.info(f"Bulk sent insert: {counts}")
+    return counts
+
+
 @connection
 def db_delete_link(id: int, conn=None, cursor=None):
     """
@@ -368,17 +528,61 @@ def db_get_user(username, conn=None, cursor=None):
     return row
 
 
-# TODO Change name?
 @connection
-def db_get_lead(conn=None, cursor=None) -> Optional[Link]:
-    # Query to select links that are parsed, have an email, and are not present in the 'sent' table
+def db_claim_lead(user_id: int, conn=None, cursor=None) -> Optional[Link]:
+    """
+    Lease the next link up for review to a reviewer.
+
+    A reviewer who still holds an unexpired lease gets the same link back
+    (and the lease is renewed), so reloading the page doesn't skip a lead.
+    Otherwise the first unclaimed or expired entry of the review queue is
+    leased. The write lock is taken up front so two reviewers can never
+    claim the same link.
+
+    :param user_id: The ID of the reviewer.
+    :return: The leased link or None if the queue is empty.
+    """
+    now = int(time.time())
+    expires_at = now + review_lease_seconds
+
+    if not conn.in_transaction:
+        cursor.execute("BEGIN IMMEDIATE")
+
+    cursor.execute(
+        """
+        SELECT link_id FROM review_queue
+        WHERE leased_by = ? AND lease_expires_at > ?
+        ORDER BY lease_expires_at LIMIT 1
+        """,
+        (user_id, now),
+    )
+    row = cursor.fetchone()
+
+    if row is None:
+        cursor.execute(
+            """
+            SELECT link_id FROM review_queue
+            WHERE lease_expires_at <= ?
+            ORDER BY lease_expires_at, link_id LIMIT 1
+            """,
+            (now,),
+        )
+        row = cursor.fetchone()
+
+    if row is None:
+        return None
+
+    link_id = row[0]
+    cursor.execute(
+        "UPDATE review_queue SET leased_by = ?, lease_expires_at = ? WHERE link_id = ?",
+        (user_id, expires_at, link_id),
+    )
+
     query = """
-    SELECT l.id, l.link, l.content_file, l.email, l.contact_name, l.pronoun, l.industry, l.city, l.area, l.parsed FROM link l
-    LEFT JOIN sent s ON l.link = s.domain
-    WHERE l.parsed = 1 AND l.email != 'None' AND s.id IS NULL
-    LIMIT 1
+    SELECT id, link, content_file, email, contact_name, pronoun, industry, city, area, parsed FROM link
+    WHERE id = ?
     """
-    cursor.execute(query)
+    cursor.execute(query, (link_id,))
     row = cursor.fetchone()
     if row is not None:
         link_data = {
@@ -399,13 +603,26 @@ def db_get_lead(conn=None, cursor=None) -> Optional[Link]:
 
 
 @connection
-def db_get_lead_count_remainder(conn=None, cursor=None) -> Optional[int]:
-    # Query to select the count of links that are parsed, have an email, and are not present in the 'sent' table
+def db_release_leads(user_id: int, conn=None, cursor=None):
+    """
+    Put every link leased by a reviewer back into the queue.
+
+    :param user_id: The ID of the reviewer.
+    :return: Number of leases released.
+    """
     query = """
-    SELECT COUNT(*) FROM link l
-    LEFT JOIN sent s ON l.link = s.domain
-    WHERE l.parsed = 1 AND l.email != 'None' AND s.id IS NULL
+    UPDATE review_queue SET leased_by = NULL, lease_expires_at = 0
+    WHERE leased_by = ?
     """
+    cursor.execute(query, (user_id,))
+    return cursor.rowcount
+
+
+@connection
+def db_get_lead_count_remainder(conn=None, cursor=None) -> Optional[int]:
+    # Links that are parsed, have an email, and are not present in the 'sent'
+    # table are kept in the review queue
+    query = "SELECT COUNT(*) FROM review_queue"
 
     cursor.execute(query)
     result = cursor.fetchone()
@@ -459,15 +676,109 @@ def db_get_leads(campaign_id, conn=None, cursor=None):
     return rows
 
 
-# TODO Data should be normalized e.g. None = none etc
+def db_iter_leads(campaign_id, since_seq=0, until_seq=None, batch_size=1000):
+    """
+    Stream the leads of a campaign in batches, see iter_rows.
+
+    Leads can be moved to another campaign after they are added, so the
+    window is on their export_seq (see migration 9), which is renewed when
+    that happens, rather than on their id.
+
+    :param since_seq: Only leads with a sequence above this watermark.
+    :param until_seq: Only leads with a sequence up to and including this one.
+    """
+    query = """
+    SELECT id, email, name, domain, pronoun, area FROM lead
+    WHERE campaign_id = ? AND export_seq > ? AND export_seq <= IFNULL(?, export_seq)
+    ORDER BY export_seq
+    """
+    return iter_rows(query, (campaign_id, since_seq, until_seq), batch_size=batch_size)
+
+
+def db_iter_all_leads(since_seq=0, until_seq=None, batch_size=1000):
+    """
+    Stream the rows of db_get_all_leads in batches, see iter_rows.
+
+    Links are complete long after they are added, so the window is on the
+    order they became complete in (completed_seq, see migration 8) rather
+    than on their id.
+
+    :param since_seq: Only links completed after this watermark.
+    :param until_seq: Only links completed up to and including this one.
+    """
+    query = """
+    SELECT link, email, contact_name, pronoun, area FROM link
+    WHERE is_complete = 1 AND completed_seq > ?
+    AND completed_seq <= IFNULL(?, completed_seq)
+    AND NOT EXISTS (SELECT 1 FROM sent WHERE sent.domain = link.link)
+    ORDER BY completed_seq
+    """
+    return iter_rows(query, (since_seq, until_seq), batch_size=batch_size)
+
+
+@connection
+def db_get_max_lead_seq(campaign_id, conn=None, cursor=None) -> int:
+    """
+    Highest lead sequence db_iter_leads can return for a campaign, used as
+    the upper bound of a delta export.
+    """
+    cursor.execute(
+        "SELECT MAX(export_seq) FROM lead WHERE campaign_id = ?", (campaign_id,)
+    )
+    result = cursor.fetchone()
+    return result[0] or 0
+
+
+@connection
+def db_get_max_completed_seq(conn=None, cursor=None) -> int:
+    """
+    Highest completion sequence db_iter_all_leads can return, used as the
+    upper bound of a delta export.
+    """
+    cursor.execute("SELECT MAX(completed_seq) FROM link WHERE is_complete = 1")
+    result = cursor.fetchone()
+    return result[0] or 0
+
+
+@connection
+def db_get_export_watermark(name: str, conn=None, cursor=None) -> int:
+    """
+    Get the id up to which an export has been delivered.
+
+    For 'all' this is a link completion sequence and for campaigns a lead
+    sequence, rather than an id.
+
+    :param name: Name of the export, e.g. 'campaign:1' or 'all'.
+    :return: The last exported id, 0 if nothing has been exported yet.
+    """
+    cursor.execute("SELECT last_id FROM export_watermark WHERE name = ?", (name,))
+    result = cursor.fetchone()
+    return result[0] if result else 0
+
+
+@connection
+def db_set_export_watermark(name: str, last_id: int, conn=None, cursor=None):
+    """
+    Record the id up to which an export has been delivered.
+
+    :param name: Name of the export, e.g. 'campaign:1' or 'all'.
+    :param last_id: The highest id included in the export.
+    """
+    query = """
+    INSERT INTO export_watermark (name, last_id) VALUES (?, ?)
+    ON CONFLICT (name) DO UPDATE
+    SET last_id = excluded.last_id, exported_at = CURRENT_TIMESTAMP
+    """
+    cursor.execute(query, (name, last_id))
+
+
 @connection
 def db_get_all_leads(conn=None, cursor=None):
+    # is_complete: parsed with email, area and contact name (see migration 5)
     query = """
     SELECT link, email, contact_name, pronoun, area FROM link
-    WHERE parsed = 1 AND LOWER(email) != 'none' AND LOWER(area) != 'none' AND LOWER(contact_name) != 'none'
-    AND link NOT IN (
-        SELECT domain FROM sent
-    )
+    WHERE is_complete = 1
+    AND NOT EXISTS (SELECT 1 FROM sent WHERE sent.domain = link.link)
     """
     cursor.execute(query)
     result = cursor.fetchall()
@@ -478,10 +789,8 @@ def db_get_all_leads(conn=None, cursor=None):
 def db_delete_all_leads(conn=None, cursor=None):
     query = """
     DELETE FROM link
-    WHERE parsed = 1 AND LOWER(email) != 'none' AND LOWER(area) != 'none' AND LOWER(contact_name) != 'none'
-    AND link NOT IN (
-        SELECT domain FROM sent
-    )
+    WHERE is_complete = 1
+    AND NOT EXISTS (SELECT 1 FROM sent WHERE sent.domain = link.link)
     """
     cursor.execute(query)
     conn.commit()
@@ -517,6 +826,59 @@ def db_get_lead_count(conn=None, cursor=None):
         return 0
 
 
+# Dashboard counters kept in the stats table. Maintained by triggers (see
+# migration 4), db_rebuild_stats recomputes them from scratch.
+STATS_QUERIES = {
+    "total_unscraped_links": "SELECT COUNT(*) FROM link WHERE parsed = 0 AND invalid = 0 AND content_file IS NULL",
+    "total_unparsed_links": "SELECT COUNT(*) FROM link WHERE parsed = 0 AND invalid = 0 AND classification = 0 AND content_file IS NOT NULL",
+    "remaining_leads": "SELECT COUNT(*) FROM review_queue",
+    "total_leads": "SELECT COUNT(*) FROM lead",
+}
+
+
+@connection
+def db_get_dashboard_stats(conn=None, cursor=None) -> dict:
+    """
+    Read the dashboard counters maintained by the stats triggers.
+
+    :return: Dictionary with the keys of STATS_QUERIES and 'campaign_counts',
+        a mapping of campaign id to number of leads.
+    """
+    stats = {name: 0 for name in STATS_QUERIES}
+
+    cursor.execute("SELECT name, value FROM stats")
+    stats.update(cursor.fetchall())
+
+    cursor.execute("SELECT campaign_id, lead_count FROM campaign_stats")
+    stats["campaign_counts"] = dict(cursor.fetchall())
+
+    return stats
+
+
+@connection
+def db_rebuild_stats(conn=None, cursor=None):
+    """
+    Recompute the dashboard counters from the tables, e.g. to repair drift
+    after the database was edited with triggers disabled.
+    """
+    for name, query in STATS_QUERIES.items():
+        cursor.execute(query)
+        value = cursor.fetchone()[0]
+        cursor.execute(
+            "INSERT OR REPLACE INTO stats (name, value) VALUES (?, ?)", (name, value)
+        )
+
+    cursor.execute("DELETE FROM campaign_stats")
+    cursor.execute(
+        """
+        INSERT INTO campaign_stats (campaign_id, lead_count)
+        SELECT campaign_id, COUNT(*) FROM lead
+        WHERE campaign_id IS NOT NULL
+        GROUP BY campaign_id
+        """
+    )
+
+
 @connection
 def db_get_sent(domain: str = None, email: str = None, conn=None, cursor=None):
     """
@@ -554,84 +916,215 @@ def db_get_sent(domain: str = None, email: str = None, conn=None, cursor=None):
         return False
 
 
+def _get_sent_values(cursor, column: str, values) -> set:
+    """Return the subset of values found in the given column of 'sent'"""
+    found = set()
+    for chunk in chunked(set(values), max_query_params):
+        placeholders = ", ".join("?" * len(chunk))
+        cursor.execute(
+            f"SELECT {column} FROM sent WHERE {column} IN ({placeholders})", chunk
+        )
+        found.update(row[0] for row in cursor.fetchall())
+    return found
+
+
 @connection
-def db_update_link_record(
-    link_id,
-    link=None,
-    content_file=None,
-    email=None,
-    contact_name=None,
-    pronoun=None,
-    industry=None,
-    city=None,
-    area=None,
-    parsed=None,
-    invalid=None,
-    contacted_at=None,
-    classification=None,
-    conn=None,
-    cursor=None,
-):
-    # Start building the SQL update statement
-    sql = "UPDATE link SET "
-    params = []
+def db_get_sent_batch(
+    domains: list = None, emails: list = None, conn=None, cursor=None
+) -> dict:
+    """
+    Checks which of the given domains and emails have a record in the 'sent' table.
 
-    # Add fields to update, if provided
-    if link is not None:
-        sql += "link = ?, "
-        params.append(link)
-    if content_file is not None:
-        sql += "content_file = ?, "
-        params.append(content_file)
-    if email is not None:
-        if isinstance(email, list):
-            email = ",".join(email)
-        sql += "email = ?, "
-        params.append(email)
-    if contact_name is not None:
-        sql += "contact_name = ?, "
-        params.append(contact_name)
-    if pronoun is not None:
-        sql += "pronoun = ?, "
-        params.append(pronoun)
-    if industry is not None:
-        if isinstance(industry, list):
-            industry = ",".join(industry)
-        sql += "industry = ?, "
-        params.append(industry)
-    if city is not None:
-        if isinstance(city, list):
-            city = ",".join(city)
-        sql += "city = ?, "
-        params.append(city)
-    if area is not None:
-        if isinstance(area, list):
-            area = ",".join(area)
-        sql += "area = ?, "
-        params.append(area)
-    if parsed is not None:
-        sql += "parsed = ?, "
-        params.append(parsed)
-    if invalid is not None:
-        sql += "invalid = ?, "
-        params.append(invalid)
-    if contacted_at is not None:
-        sql += "contacted_at = ?, "
-        params.append(contacted_at)
-    if classification is not None:
-        sql += "classification = ?, "
-        params.append(classification)
+    Parameters:
+    domains (list): The domains to search for. Default is None.
+    emails (list): The emails to search for. Default is None.
 
-    # Remove trailing comma and space
-    sql = sql.rstrip(", ")
+    Returns:
+    dict: 'domains' and 'emails', the sets of given values that were found.
+    """
+    return {
+        "domains": _get_sent_values(cursor, "domain", domains or []),
+        "emails": _get_sent_values(cursor, "email", emails or []),
+    }
+
+
+# Columns of the link table that can be set through db_update_link_record
+LINK_UPDATE_COLUMNS = (
+    "link",
+    "content_file",
+    "email",
+    "contact_name",
+    "pronoun",
+    "industry",
+    "city",
+    "area",
+    "parsed",
+    "invalid",
+    "contacted_at",
+    "classification",
+    "text_hash",
+    "text_digest",
+    "image_hash",
+)
+
+
+def _link_update_sql(columns) -> str:
+    """Build the UPDATE statement setting the given columns of a link"""
+    unknown = set(columns) - set(LINK_UPDATE_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown link columns: {', '.join(sorted(unknown))}")
+
+    return f"UPDATE link SET {', '.join(f'{column} = ?' for column in columns)} WHERE id = ?"
 
-    # Add the WHERE clause to specify which record to update
-    sql += " WHERE id = ?"
+
+@connection
+def db_update_link_record(link_id, conn=None, cursor=None, **fields):
+    """
+    Update the given columns of a link.
+
+    Text columns are normalized first, so 'None', empty strings and lists
+    from the AI parser are stored as NULL or a single canonical value.
+
+    :param link_id: The ID of the link to update.
+    :param fields: Column values keyed by names from LINK_UPDATE_COLUMNS.
+    """
+    if not fields:
+        return
+
+    sql = _link_update_sql(fields)
+    fields = normalize_link_fields(fields)
+
+    params = list(fields.values())
     params.append(link_id)
     data = tuple(params)
     # Execute the SQL command
     cursor.execute(sql, data)
-    conn.commit()
+
+
+@connection
+def db_update_link_records(updates: list, conn=None, cursor=None) -> int:
+    """
+    Apply many partial link updates in one transaction.
+
+    Consecutive updates setting the same columns share one executemany
+    call. The order of the updates is kept, so when a link is updated
+    twice the later values win.
+
+    :param updates: Dictionaries with the link 'id' and column values keyed
+        by names from LINK_UPDATE_COLUMNS, normalized as in db_update_link_record.
+    :return: Number of links updated.
+    """
+    updated = 0
+
+    def columns(update):
+        return tuple(key for key in update if key != "id")
+
+    for update_columns, group in itertools.groupby(updates, key=columns):
+        if not update_columns:
+            continue
+
+        sql = _link_update_sql(update_columns)
+        data = []
+        for update in group:
+            fields = normalize_link_fields({key: update[key] for key in update_columns})
+            data.append((*fields.values(), update["id"]))
+
+        cursor.executemany(sql, data)
+        updated += cursor.rowcount
+
+    return updated
+
+
+# Fingerprint columns of the link table and the links worth matching against
+SIMILAR_LINK_KINDS = {
+    "text": ("text_hash", "parsed = 1"),
+    "image": ("image_hash", "classification IS NOT NULL AND classification != 0"),
+}
+
+
+@connection
+def db_find_similar_link(
+    kind: str,
+    fingerprint: int,
+    max_distance: int = 6,
+    exclude_id: int = None,
+    digest: str = None,
+    max_candidates: int = 5000,
+    conn=None,
+    cursor=None,
+):
+    """
+    Find the closest already processed link with a similar fingerprint.
+
+    A parsed link with the same text `digest` is returned first. Otherwise
+    candidates sharing enough bands of the fingerprint are looked up in
+    fingerprint_band, which finds every link within FINGERPRINT_BANDS - 1
+    bits, and the closest one within `max_distance` is returned.
+
+    :param kind: 'text' for parsed links, 'image' for classified ones.
+    :return: Dictionary with the link's columns and 'distance', or None.
+    """
+    if max_distance >= FINGERPRINT_BANDS:
+        raise ValueError(f"max_distance must be below {FINGERPRINT_BANDS}")
+
+    column, processed = SIMILAR_LINK_KINDS[kind]
+    select = f"""
+        SELECT id, link, email, contact_name, pronoun, industry, city, area,
+            classification, text_digest, {column}
+        FROM link
+    """
+
+    if digest is not None and kind == "text":
+        cursor.execute(
+            f"{select} WHERE text_digest = ? AND id != IFNULL(?, -1) AND {processed}"
+            " LIMIT 1",
+            (digest, exclude_id),
+        )
+        row = cursor.fetchone()
+        if row is not None:
+            columns = [description[0] for description in cursor.description]
+            match = dict(zip(columns, row))
+            match.pop(column)
+            return {**match, "distance": 0}
+
+    bands = fingerprint_bands(fingerprint)
+    band_filter = " OR ".join(["(band = ? AND value = ?)"] * len(bands))
+    band_params = [value for band in bands for value in band]
+
+    # A link d bits away differs in at most d bands, so it shares at least
+    # FINGERPRINT_BANDS - d of them. Candidates sharing the most bands are
+    # the closest, so they are kept when there are too many.
+    cursor.execute(
+        f"""
+        {select}
+        JOIN (
+            SELECT link_id, COUNT(*) AS shared FROM fingerprint_band
+            WHERE kind = ? AND ({band_filter})
+            GROUP BY link_id
+            HAVING shared >= ?
+        ) AS candidate ON candidate.link_id = link.id
+        WHERE id != IFNULL(?, -1) AND {processed}
+        ORDER BY candidate.shared DESC
+        LIMIT ?
+        """,
+        (
+            kind,
+            *band_params,
+            FINGERPRINT_BANDS - max_distance,
+            exclude_id,
+            max_candidates,
+        ),
+    )
+
+    columns = [description[0] for description in cursor.description]
+    best = None
+    for row in cursor.fetchall():
+        candidate = dict(zip(columns, row))
+        distance = hamming_distance(fingerprint, candidate.pop(column))
+        if distance <= max_distance and (best is None or distance < best["distance"]):
+            best = {**candidate, "distance": distance}
+
+    return best
 
 
 @connection
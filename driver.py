@@ -1,112 +1,341 @@
+import asyncio
+import io
 import logging
+import multiprocessing
 import os
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from selenium import webdriver
-from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.common.exceptions import (
+    InvalidSessionIdException,
+    NoSuchWindowException,
+    TimeoutException,
+    WebDriverException,
+)
 from selenium.webdriver.common.by import By
 from selenium.webdriver.firefox.options import Options as FirefoxOptions
 from PIL import Image
 
-from services import update_link_record
+from services import LinkUpdateBuffer
+from fingerprints import image_hash, text_hash, text_digest
+from fetcher import fetch_links
+from resolver import DnsCache, filter_resolvable
 
 # TODO Maybe crawl a couple of pages and get the info?
 
 
-def merge_images(image_path_1, image_path_2, merged_image_path):
-    # Open the first and second image
-    image1 = Image.open(image_path_1)
-    image2 = Image.open(image_path_2)
+def merge_screenshots(top: bytes, bottom: bytes, path: str, quality: int = 60):
+    """
+    Stitch two PNG screenshots below each other, halve the size and save
+    the result as a JPEG.
 
-    # Calculate dimensions for the merged image
-    width = max(image1.width, image2.width)
-    height = image1.height + image2.height
+    :return: The image hash of the merged screenshot.
+    """
+    with Image.open(io.BytesIO(top)) as image1, Image.open(
+        io.BytesIO(bottom)
+    ) as image2:
+        merged_image = Image.new(
+            "RGB", (max(image1.width, image2.width), image1.height + image2.height)
+        )
+        merged_image.paste(image1, (0, 0))
+        merged_image.paste(image2, (0, image1.height))
 
-    # Create a new image with the appropriate height and width
-    merged_image = Image.new("RGB", (width, height))
+    # reduce() averages 2x2 blocks, much faster than resize() and just as
+    # good for halving
+    merged_image = merged_image.reduce(2)
+    merged_image.save(path, "JPEG", quality=quality)
+    return image_hash(merged_image)
 
-    # Paste the first image at the top
-    merged_image.paste(image1, (0, 0))
 
-    # Paste the second image below the first
-    merged_image.paste(image2, (0, image1.height))
+# Errors of a page load that mean the domain doesn't exist
+DNS_ERRORS = ("ERR_NAME_NOT_RESOLVED", "DNS_PROBE_FINISHED_NXDOMAIN", "dnsNotFound")
 
-    # Resize the image to 50% of its current size
-    new_width = int(merged_image.width * 0.5)
-    new_height = int(merged_image.height * 0.5)
-    merged_image = merged_image.resize((new_width, new_height))
+# Errors after which the browser can't be used anymore
+BROWSER_ERRORS = (InvalidSessionIdException, NoSuchWindowException)
 
-    # Save the merged image
-    merged_image.save(merged_image_path, "JPEG", quality=60)
 
-
-def get_content_from_url(links: list, outfolder: str):
+def create_driver(headless: bool = True, page_load_timeout: float = 20):
     # Set the desired capabilities with the page load strategy
     options = FirefoxOptions()
     options.set_capability("pageLoadStrategy", "normal")
+    if headless:
+        options.add_argument("-headless")
 
-    # Instantiate the Chrome driver with the specified capabilities
     driver = webdriver.Firefox(options=options)
 
     # Set the page load timeout
-    driver.set_page_load_timeout(20)  # Adjust the timeout as needed
+    driver.set_page_load_timeout(page_load_timeout)
 
-    # Make the browser full screen
-    driver.maximize_window()
+    # A fixed window size, so screenshots look the same headless or not
+    driver.set_window_size(1920, 1080)
 
-    for record in links:
-        id, link = record
-
-        try:
-            driver.get("http://" + link)
-        except TimeoutException:
-            logging.error(f"Timeout error for link {link}")
-            # continue
-        except WebDriverException as e:
-            if "ERR_NAME_NOT_RESOLVED" in str(e):
-                update_link_record(link_id=id, invalid=True)
-                logging.error(f"ERR_NAME_NOT_RESOLVED: {link}")
-            if "DNS_PROBE_FINISHED_NXDOMAIN" in str(e):
-                update_link_record(link_id=id, invalid=True)
-                logging.error(f"DNS_PROBE_FINISHED_NXDOMAIN: {link}")
-            if "dnsNotFound" in str(e):
-                update_link_record(link_id=id, invalid=True)
-                logging.error(f"dnsNotFound: {link}")
-            else:
-                logging.error(f"Error: {e}")
-            continue
-        except Exception as e:
-            logging.error(f"Error fetching link {link}: {e}")
-            continue
+    return driver
+
+
+def scrape_link(driver, id: int, link: str, outfolder: str, executor=None):
+    """
+    Save the text and a screenshot of a link.
+
+    The screenshots are kept in memory and merged into a single
+    '<link>.jpg'. With an `executor` the merging runs there, so the browser
+    can load the next page meanwhile, and a future of the fields is
+    returned instead.
+
+    :return: Fields to update the link with, or None to leave it as is.
+    :raises: One of BROWSER_ERRORS when the browser has crashed.
+    """
+    try:
+        driver.get("http://" + link)
+    except TimeoutException:
+        logging.error(f"Timeout error for link {link}")
+        # Carry on with whatever has loaded
+    except BROWSER_ERRORS:
+        raise
+    except WebDriverException as e:
+        for error in DNS_ERRORS:
+            if error in str(e):
+                logging.error(f"{error}: {link}")
+                return {"invalid": True}
+        logging.error(f"Error: {e}")
+        return None
+    except Exception as e:
+        logging.error(f"Error fetching link {link}: {e}")
+        return None
+
+    try:
+        text_content = driver.find_element(by=By.TAG_NAME, value="body").text
+        text_file_path = f"{outfolder}/{link}.txt"
+
+        with open(text_file_path, "w", encoding="utf-8") as out_file:
+            out_file.write(text_content)
 
-        try:
-            text_content = driver.find_element(by=By.TAG_NAME, value="body").text
-            text_file_path = f"{outfolder}/{link}.txt"
-            screenshot_final = f"{outfolder}/{link}.png"  # Path for the screenshot
-            screenshot_1 = f"{outfolder}/{link}_1.png"
-            screenshot_2 = f"{outfolder}/{link}_2.png"
+        screenshot_1 = driver.get_screenshot_as_png()
 
-            with open(text_file_path, "w", encoding="utf-8") as out_file:
-                out_file.write(text_content)
+        driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
 
-            driver.save_screenshot(screenshot_1)
+        screenshot_2 = driver.get_screenshot_as_png()
+    except BROWSER_ERRORS:
+        raise
+    # TODO Update link record with error message so it can be skipped next time
+    except Exception as e:
+        logging.error(f"Error processing link {link}: {e}")
+        return {"invalid": True}
 
-            driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
+    args = (link, outfolder, text_content, screenshot_1, screenshot_2)
+    if executor is not None:
+        return executor.submit(finish_link, *args)
+    return finish_link(*args)
 
-            driver.save_screenshot(screenshot_2)
 
-            # Merge screenshots
-            merge_images(screenshot_1, screenshot_2, screenshot_final)
+def finish_link(
+    link: str, outfolder: str, text_content: str, screenshot_1, screenshot_2
+):
+    """Merge the screenshots of a scraped link and return its fields"""
+    try:
+        screenshot_hash = merge_screenshots(
+            screenshot_1, screenshot_2, f"{outfolder}/{link}.jpg"
+        )
+    except Exception as e:
+        logging.error(f"Error merging screenshots for {link}: {e}")
+        return {"invalid": True}
 
-            if os.path.exists(screenshot_final):
-                print(f"Updating link: {link}")
-                update_link_record(link_id=id, content_file=link)
-                os.remove(screenshot_1)
-                os.remove(screenshot_2)
+    print(f"Updating link: {link}")
+    return {
+        "content_file": link,
+        "text_hash": text_hash(text_content, link),
+        "text_digest": text_digest(text_content),
+        "image_hash": screenshot_hash,
+    }
+
+
+def scrape_worker(
+    tasks,
+    results,
+    outfolder: str,
+    pages_per_browser: int = 50,
+    batch_size: int = 10,
+    headless: bool = True,
+    page_load_timeout: float = 20,
+):
+    """
+    Worker process: scrape links from `tasks` until a None arrives.
+
+    The browser is replaced after `pages_per_browser` pages, so its memory
+    use doesn't grow without bound, and whenever it crashes. Screenshots
+    are merged by a thread next to the browser. Results are sent to
+    `results` as lists of (id, fields), followed by the worker's pid when
+    done.
+    """
+    driver = None
+    pages = 0
+    batch = []
+    pending = []
+    # Pillow releases the GIL while encoding, so one thread keeps up
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    def collect(wait=False):
+        nonlocal batch, pending
+        waiting = []
+        for id, future in pending:
+            if wait or future.done():
+                batch.append((id, future.result()))
             else:
-                logging.error(f"Screenshot doesnt exist for {link}")
-        # TODO Update link record with error message so it can be skipped next time
-        except Exception as e:
-            logging.error(f"Error processing link {link}: {e}")
-            update_link_record(link_id=id, invalid=True)
+                waiting.append((id, future))
+        pending = waiting
+        if batch and (wait or len(batch) >= batch_size):
+            results.put(batch)
+            batch = []
+
+    try:
+        for id, link in iter(tasks.get, None):
+            if driver is None:
+                driver = create_driver(headless, page_load_timeout)
+
+            try:
+                fields = scrape_link(driver, id, link, outfolder, executor)
+            except BROWSER_ERRORS as e:
+                logging.error(f"Browser crashed on {link}, restarting it: {e}")
+                fields = None
+                pages = pages_per_browser
+
+            if isinstance(fields, Future):
+                pending.append((id, fields))
+            elif fields:
+                batch.append((id, fields))
+            collect()
+
+            pages += 1
+            if pages >= pages_per_browser:
+                quit_driver(driver)
+                driver, pages = None, 0
+    finally:
+        collect(wait=True)
+        executor.shutdown()
+        quit_driver(driver)
+        results.put(os.getpid())
+
+
+def quit_driver(driver):
+    if driver is None:
+        return
+    try:
+        driver.quit()
+    except Exception as e:
+        logging.error(f"Error closing browser: {e}")
+
+
+def get_content_from_url(
+    links: list,
+    outfolder: str,
+    workers: int = 1,
+    pages_per_browser: int = 50,
+    headless: bool = True,
+    page_load_timeout: float = 20,
+    screenshots: bool = True,
+    http_concurrency: int = 50,
+    dns_concurrency: int = 100,
+    dns_cache: str = None,
+    dns_ttl: float = 3600,
+    resolver=None,
+):
+    """
+    Scrape links with a pool of browsers, each in its own process.
+
+    Workers take links from a shared queue. Their results are sent to the
+    API in bulk, and a worker that dies is replaced while links are left.
+
+    Domains are resolved first, `dns_concurrency` at a time, and links
+    whose domain doesn't exist are marked invalid without being visited.
+    Links are then fetched over plain HTTP, `http_concurrency` at a time,
+    and only pages that need JavaScript, failed to load or (with
+    `screenshots`) need a screenshot go to the browsers, see
+    fetcher.needs_browser. A falsy `http_concurrency` sends every link to
+    the browsers.
+    """
+    # Send link updates to the API in bulk
+    writer = LinkUpdateBuffer()
+
+    if dns_concurrency:
+        links, dead = asyncio.run(
+            filter_resolvable(
+                links,
+                concurrency=dns_concurrency,
+                resolver=resolver,
+                cache=DnsCache(dns_cache, ttl=dns_ttl),
+            )
+        )
+        for id in dead:
+            writer.add(id, invalid=True)
+        print(f"{len(dead)} links don't resolve, {len(links)} left")
+
+    if http_concurrency:
+        updates, links = asyncio.run(
+            fetch_links(
+                links,
+                outfolder,
+                concurrency=http_concurrency,
+                screenshots=screenshots,
+            )
+        )
+        for id, fields in updates:
+            writer.add(id, **fields)
+        print(f"Fetched {len(updates)} links without a browser")
+
+    if not links:
+        writer.close()
+        return
+
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    for record in links:
+        tasks.put(tuple(record))
+
+    def start_worker():
+        process = multiprocessing.Process(
+            target=scrape_worker,
+            args=(tasks, results, outfolder, pages_per_browser),
+            kwargs={"headless": headless, "page_load_timeout": page_load_timeout},
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    processes = [start_worker() for _ in range(max(1, min(workers, len(links))))]
+    for _ in processes:
+        tasks.put(None)
+
+    running = len(processes)
+    done = set()
+    restarts = 0
+
+    try:
+        while running:
+            try:
+                batch = results.get(timeout=5)
+            except queue.Empty:
+                # Replace workers that died without finishing, their None is
+                # still in the queue for the new worker
+                for i, process in enumerate(processes):
+                    if process.exitcode in (None, 0) or process.pid in done:
+                        continue
+                    logging.error(f"Scraper exited with {process.exitcode}")
+                    done.add(process.pid)
+                    if restarts < 3 * len(processes):
+                        restarts += 1
+                        processes[i] = start_worker()
+                    else:
+                        running -= 1
+                continue
+
+            if isinstance(batch, int):
+                done.add(batch)
+                running -= 1
+                continue
 
-    driver.quit()
+            for id, fields in batch:
+                writer.add(id, **fields)
+    finally:
+        for process in processes:
+            process.join(timeout=30)
+        writer.close()
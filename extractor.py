@@ -0,0 +1,234 @@
+import re
+
+from content_reducer import EMAIL_PATTERN
+
+# Postcode followed by a place name on the same line, e.g. '8000 Aarhus C'
+ADDRESS_PATTERN = re.compile(r"\b(\d{4})[ \t]+(?=([^\n]+))")
+
+# Postcode ranges of the larger cities, first match wins
+POSTCODE_RANGES = [
+    (1000, 1799, "København"),
+    (1800, 2000, "Frederiksberg"),
+    (2100, 2450, "København"),
+    (5000, 5270, "Odense"),
+    (8000, 8270, "Aarhus"),
+    (9000, 9220, "Aalborg"),
+]
+
+# Postcodes of other towns
+POSTCODES = {
+    2500: "Valby",
+    2600: "Glostrup",
+    2605: "Brøndby",
+    2610: "Rødovre",
+    2620: "Albertslund",
+    2630: "Taastrup",
+    2635: "Ishøj",
+    2650: "Hvidovre",
+    2670: "Greve",
+    2700: "Brønshøj",
+    2720: "Vanløse",
+    2730: "Herlev",
+    2750: "Ballerup",
+    2770: "Kastrup",
+    2791: "Dragør",
+    2800: "Kongens Lyngby",
+    2820: "Gentofte",
+    2840: "Holte",
+    2860: "Søborg",
+    2880: "Bagsværd",
+    2900: "Hellerup",
+    2920: "Charlottenlund",
+    2970: "Hørsholm",
+    3000: "Helsingør",
+    3400: "Hillerød",
+    3450: "Allerød",
+    3460: "Birkerød",
+    3500: "Værløse",
+    3520: "Farum",
+    3600: "Frederikssund",
+    3700: "Rønne",
+    4000: "Roskilde",
+    4100: "Ringsted",
+    4200: "Slagelse",
+    4300: "Holbæk",
+    4400: "Kalundborg",
+    4600: "Køge",
+    4700: "Næstved",
+    4800: "Nykøbing F",
+    4900: "Nakskov",
+    5700: "Svendborg",
+    5800: "Nyborg",
+    6000: "Kolding",
+    6100: "Haderslev",
+    6200: "Aabenraa",
+    6400: "Sønderborg",
+    6700: "Esbjerg",
+    6800: "Varde",
+    7000: "Fredericia",
+    7100: "Vejle",
+    7400: "Herning",
+    7430: "Ikast",
+    7500: "Holstebro",
+    7700: "Thisted",
+    7800: "Skive",
+    8600: "Silkeborg",
+    8660: "Skanderborg",
+    8700: "Horsens",
+    8800: "Viborg",
+    8900: "Randers",
+    9800: "Hjørring",
+    9900: "Frederikshavn",
+}
+
+# Other ways a city is written in addresses
+CITY_ALIASES = {
+    "København": ("København", "Kbh", "Copenhagen"),
+    "Aarhus": ("Aarhus", "Århus"),
+}
+
+# Mailbox names that don't belong to a person
+GENERIC_MAILBOXES = {
+    "admin",
+    "booking",
+    "bogholderi",
+    "butik",
+    "faktura",
+    "hej",
+    "hello",
+    "info",
+    "job",
+    "kontakt",
+    "kundeservice",
+    "mail",
+    "noreply",
+    "office",
+    "ordre",
+    "post",
+    "regnskab",
+    "salg",
+    "sales",
+    "service",
+    "shop",
+    "support",
+    "webmaster",
+}
+
+# Things that look like emails but aren't, e.g. 'logo@2x.png'
+IGNORED_EMAIL_SUFFIXES = (".png", ".jpg", ".jpeg", ".gif", ".svg", ".webp")
+IGNORED_EMAIL_DOMAINS = ("example.com", "sentry.io", "wixpress.com", "domain.com")
+
+
+def lookup_postcode(postcode: int):
+    """Return the city of a postcode, if it is in the gazetteer"""
+    if postcode in POSTCODES:
+        return POSTCODES[postcode]
+    for start, end, city in POSTCODE_RANGES:
+        if start <= postcode <= end:
+            return city
+    return None
+
+
+def postcode_cities(postcode: int) -> list:
+    """
+    Return the cities a postcode can belong to.
+
+    Postcodes missing from the gazetteer, like '6705 Esbjerg Ø', are
+    matched against the towns whose postcodes share the first two digits.
+    """
+    city = lookup_postcode(postcode)
+    if city:
+        return [city]
+    return [city for code, city in POSTCODES.items() if code // 100 == postcode // 100]
+
+
+def find_email(text: str, link: str = None):
+    """
+    Return the most likely contact email of a page.
+
+    An address on the site's own domain is preferred over others.
+    """
+    emails = []
+    for email in EMAIL_PATTERN.findall(text):
+        email = email.lower().rstrip(".")
+        if email.endswith(IGNORED_EMAIL_SUFFIXES):
+            continue
+        if email.split("@")[1].endswith(IGNORED_EMAIL_DOMAINS):
+            continue
+        emails.append(email)
+
+    if not emails:
+        return None
+
+    if link:
+        for email in emails:
+            if email.split("@")[1].endswith(link.lower()):
+                return email
+
+    return emails[0]
+
+
+def find_city(text: str):
+    """
+    Return the city of the first Danish address on a page.
+
+    A postcode only counts when it is followed by the name of its city on
+    the same line, which keeps e.g. 'siden 1987' or 'Pris fra 1500 DKK'
+    from being read as an address.
+    """
+    for postcode, rest in ADDRESS_PATTERN.findall(text):
+        rest = rest.lower()
+        for city in postcode_cities(int(postcode)):
+            for name in CITY_ALIASES.get(city, (city,)):
+                if re.match(re.escape(name.lower()) + r"(?!\w)", rest):
+                    return city
+
+    return None
+
+
+def find_contact_name(email: str):
+    """
+    Return the first name in a personal mailbox like 'lars.hansen@...'.
+
+    Only 'first.last' style mailboxes are used, a single word could just as
+    well be a company or a generic mailbox.
+    """
+    mailbox = email.split("@")[0]
+    parts = mailbox.split(".")
+    if len(parts) != 2 or not all(part.isalpha() for part in parts):
+        return None
+    if parts[0] in GENERIC_MAILBOXES or len(parts[0]) < 2:
+        return None
+    return parts[0].title()
+
+
+def extract_fields(text: str, link: str = None, keys: list = None) -> dict:
+    """
+    Pull the fields that can be found without an LLM from page text.
+
+    :param text: Text scraped from the page.
+    :param link: Domain of the page, used to pick the right email.
+    :param keys: Keys to return, as in config.json aiparser.keys.
+    :return: Dictionary with the keys that were found.
+    """
+    fields = {}
+
+    email = find_email(text, link)
+    if email:
+        fields["e-mail"] = email
+
+        contact_name = find_contact_name(email)
+        if contact_name:
+            fields["contact_name"] = contact_name
+            fields["pronoun"] = "du"
+
+    city = find_city(text)
+    if city:
+        fields["city"] = city
+        # The prompt asks for the city or the greater area
+        fields["area"] = city
+
+    if keys is not None:
+        fields = {key: value for key, value in fields.items() if key in keys}
+
+    return fields
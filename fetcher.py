@@ -0,0 +1,169 @@
+import re
+import asyncio
+import logging
+from html.parser import HTMLParser
+
+import httpx
+
+from extractor import find_email
+from fingerprints import text_hash, text_digest
+
+# Tags whose content is never shown
+HIDDEN_TAGS = {"script", "style", "noscript", "template", "svg", "head", "iframe"}
+
+# Tags that start a new line of text, like in the browser's innerText
+# fmt: off
+BLOCK_TAGS = {
+    "address", "article", "aside", "blockquote", "br", "dd", "div", "dl", "dt",
+    "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "li",
+    "main", "nav", "ol", "p", "pre", "section", "table", "td", "th", "tr", "ul",
+}
+# fmt: on
+
+# Signs of a page that is built by JavaScript in the browser
+JS_APP_PATTERN = re.compile(
+    r'<div id="(?:root|app|__next|__nuxt)"\s*>\s*</div>|ng-app|data-reactroot|'
+    r"enable javascript|aktiv[eé]r javascript|slå javascript til",
+    re.IGNORECASE,
+)
+
+# Browsers get different (or any) pages than scripts on some sites
+headers = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:121.0) Gecko/20100101 Firefox/121.0",
+    "Accept": "text/html,application/xhtml+xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "da,en;q=0.8",
+}
+
+
+class TextExtractor(HTMLParser):
+    """Collects the visible text of an HTML page, one line per block"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.hidden = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in HIDDEN_TAGS:
+            self.hidden += 1
+        elif tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in HIDDEN_TAGS:
+            self.hidden = max(0, self.hidden - 1)
+        elif tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self.hidden:
+            self.parts.append(data)
+
+    def text(self) -> str:
+        lines = (" ".join(line.split()) for line in "".join(self.parts).splitlines())
+        return "\n".join(line for line in lines if line)
+
+
+def html_to_text(html: str) -> str:
+    parser = TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return parser.text()
+
+
+def looks_js_rendered(html: str, text: str, min_text: int = 50) -> bool:
+    """Does the page need a browser to show its content?"""
+    if JS_APP_PATTERN.search(html):
+        return True
+    # Next to no text, but scripts that probably add it
+    return len(text) < min_text and "<script" in html.lower()
+
+
+async def fetch_html(client: httpx.AsyncClient, link: str, max_bytes: int):
+    """Fetch the HTML of a link, None when it isn't an HTML page"""
+    async with client.stream("GET", "http://" + link) as response:
+        response.raise_for_status()
+        if "html" not in response.headers.get("content-type", "html"):
+            return None
+
+        content = bytearray()
+        async for chunk in response.aiter_bytes():
+            content += chunk
+            if len(content) >= max_bytes:
+                break
+
+        return bytes(content).decode(response.encoding or "utf-8", errors="replace")
+
+
+def needs_browser(html: str, text: str, link: str, screenshots: bool) -> bool:
+    """
+    Does a fetched page have to be loaded in the browser after all?
+
+    Pages rendered by JavaScript do. With `screenshots`, so do pages with an
+    email: they may become leads, which are classified and reviewed by their
+    screenshot. Pages without one are skipped by the parser anyway.
+    """
+    if looks_js_rendered(html, text):
+        return True
+    return screenshots and find_email(text, link) is not None
+
+
+async def fetch_links(
+    links: list,
+    outfolder: str,
+    concurrency: int = 50,
+    timeout: float = 10,
+    max_bytes: int = 2_000_000,
+    screenshots: bool = False,
+):
+    """
+    Fetch the text of links over plain HTTP, without a browser.
+
+    Pages are fetched concurrently through one pooled client and their
+    visible text is saved like the browser scraper does. Links that fail to
+    load or aren't HTML are left for the browser, as are the pages
+    needs_browser picks.
+
+    :return: Link updates as (id, fields), and the links left for the browser.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    updates = []
+    browser_links = []
+
+    async def fetch(client, id, link):
+        async with semaphore:
+            try:
+                html = await fetch_html(client, link, max_bytes)
+            except (httpx.HTTPError, UnicodeDecodeError, LookupError) as e:
+                logging.info(f"Plain fetch failed for {link}: {e}")
+                html = None
+
+        text = html_to_text(html) if html else ""
+        if not html or needs_browser(html, text, link, screenshots):
+            browser_links.append((id, link))
+            return
+
+        with open(f"{outfolder}/{link}.txt", "w", encoding="utf-8") as out_file:
+            out_file.write(text)
+
+        print(f"Updating link: {link}")
+        updates.append(
+            (
+                id,
+                {
+                    "content_file": link,
+                    "text_hash": text_hash(text, link),
+                    "text_digest": text_digest(text),
+                },
+            )
+        )
+
+    async with httpx.AsyncClient(
+        headers=headers,
+        timeout=timeout,
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=concurrency),
+    ) as client:
+        await asyncio.gather(*(fetch(client, id, link) for id, link in links))
+
+    return updates, browser_links
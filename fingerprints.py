@@ -0,0 +1,83 @@
+import re
+import hashlib
+
+from PIL import Image
+
+WORD_PATTERN = re.compile(r"\w+")
+
+# Public suffixes of two labels, the rest are taken to be one label ('.dk')
+MULTI_LABEL_SUFFIXES = {"co.uk", "org.uk", "com.au", "co.nz", "com.br", "co.jp"}
+
+
+def to_signed(value: int) -> int:
+    """Fit an unsigned 64 bit value in a SQLite INTEGER"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def image_hash(image, size: int = 8) -> int:
+    """
+    Difference hash of a screenshot, given as a path or a PIL image.
+
+    The image is shrunk to (size + 1) x size greyscale pixels and every bit
+    says whether a pixel is brighter than its right neighbour, so pages
+    that look alike get hashes a few bits apart.
+    """
+    if isinstance(image, str):
+        with Image.open(image) as opened:
+            return image_hash(opened, size)
+
+    pixels = list(image.convert("L").resize((size + 1, size), Image.LANCZOS).getdata())
+
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+
+    return to_signed(value)
+
+
+def registrable_name(link: str) -> str:
+    """Name a domain is registered under, e.g. 'x' for 'www.x.dk'"""
+    labels = link.lower().split("/")[0].split(".")
+    suffix = 2 if ".".join(labels[-2:]) in MULTI_LABEL_SUFFIXES else 1
+    return labels[-suffix - 1] if len(labels) > suffix else labels[0]
+
+
+def mask_words(text: str, phrase: str) -> str:
+    """Blank out `phrase` where it stands on its own, not inside other words"""
+    return re.sub(rf"(?<!\w){re.escape(phrase)}(?!\w)", " ", text)
+
+
+def text_hash(text: str, link: str = None) -> int:
+    """
+    SimHash of page text over pairs of consecutive words.
+
+    Pages sharing most of their text (templates, parked domains) get hashes
+    a few bits apart. The page's own domain and numbers (years, prices,
+    phone numbers) are left out, as they differ between otherwise equal
+    pages.
+    """
+    text = text.lower()
+    if link:
+        link = link.lower()
+        text = mask_words(mask_words(text, link), registrable_name(link))
+    words = ["#" if word.isdigit() else word for word in WORD_PATTERN.findall(text)]
+    features = [" ".join(pair) for pair in zip(words, words[1:])] or words
+
+    weights = [0] * 64
+    for feature in features:
+        digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+        bits = int.from_bytes(digest, "big")
+        for i in range(64):
+            weights[i] += 1 if bits >> i & 1 else -1
+
+    value = sum(1 << i for i, weight in enumerate(weights) if weight > 0)
+    return to_signed(value)
+
+
+def text_digest(text: str) -> str:
+    """Hash of the words of a page, equal for pages with the same text"""
+    words = WORD_PATTERN.findall(text.lower())
+    return hashlib.sha256(" ".join(words).encode("utf-8")).hexdigest()
@@ -0,0 +1,115 @@
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+
+def make_key(*parts) -> str:
+    """Hash the parts of a request (prompt version, model, content...) into a cache key"""
+    data = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent cache of LLM responses.
+
+    Responses are stored in a SQLite file, with a small in-memory LRU in
+    front so repeated hits don't touch the disk. Entries older than
+    `max_age_days` are evicted, as are the oldest entries once the file
+    holds more than `max_entries`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = 100000,
+        max_age_days: float = 90,
+        memory_entries: int = 1000,
+        evict_every: int = 1000,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+        self.memory_entries = memory_entries
+        self.evict_every = evict_every
+        self.memory = OrderedDict()
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS response(
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL)
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_response_created_at ON response(created_at)"
+        )
+        self.conn.commit()
+        self.evict()
+
+    def get(self, key: str) -> Optional[str]:
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        row = self.conn.execute(
+            "SELECT value FROM response WHERE key = ? AND created_at > ?",
+            (key, time.time() - self.max_age),
+        ).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._remember(key, row[0])
+        return row[0]
+
+    def set(self, key: str, value: str):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO response (key, value, created_at) VALUES (?, ?, ?)",
+            (key, value, time.time()),
+        )
+        self.conn.commit()
+        self._remember(key, value)
+
+        self.writes += 1
+        if self.writes % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+        """Drop expired entries and the oldest ones above max_entries"""
+        self.conn.execute(
+            "DELETE FROM response WHERE created_at <= ?", (time.time() - self.max_age,)
+        )
+        self.conn.execute(
+            """
+            DELETE FROM response WHERE key IN (
+                SELECT key FROM response ORDER BY created_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_entries,),
+        )
+        self.conn.commit()
+
+    def close(self):
+        logging.info(f"LLM cache: {self.hits} hits, {self.misses} misses")
+        self.conn.close()
+
+    def _remember(self, key: str, value: str):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
@@ -0,0 +1,496 @@
+import logging
+
+from database import connection, tables, db_rebuild_stats
+from utils import LINK_TEXT_FIELDS, normalize_link_fields
+
+
+def create_base_tables(conn, cursor):
+    """Create the original tables, if they don't exist already"""
+    for create_table in tables.values():
+        create_table(conn=conn)
+
+
+def rebuild_stats(conn, cursor):
+    db_rebuild_stats(conn=conn)
+
+
+def normalize_link_values(conn, cursor, batch_size=1000):
+    """Normalize the text columns of links written before normalization"""
+    columns = list(LINK_TEXT_FIELDS)
+    select = (
+        f"SELECT id, {', '.join(columns)} FROM link WHERE id > ? ORDER BY id LIMIT ?"
+    )
+    update = f"UPDATE link SET {', '.join(f'{c} = ?' for c in columns)} WHERE id = ?"
+
+    last_id = 0
+    while True:
+        cursor.execute(select, (last_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+
+        updates = []
+        for row in rows:
+            current = dict(zip(columns, row[1:]))
+            normalized = normalize_link_fields(current)
+            if normalized != current:
+                updates.append((*normalized.values(), row[0]))
+
+        cursor.executemany(update, updates)
+        last_id = rows[-1][0]
+
+
+# A link is up for review when it is parsed, has an email and the domain
+# hasn't been sent to. Used by the review_queue triggers on NEW/OLD rows.
+REVIEWABLE = """
+    IFNULL({row}.parsed, 0) = 1
+    AND {row}.email IS NOT NULL AND {row}.email != 'None'
+    AND NOT EXISTS (SELECT 1 FROM sent WHERE sent.domain = {row}.link)
+"""
+
+
+# Link counters shown on the dashboard, mirroring STATS_QUERIES in database.py
+UNSCRAPED = (
+    "IFNULL({row}.parsed = 0 AND {row}.invalid = 0 AND {row}.content_file IS NULL, 0)"
+)
+UNPARSED = """IFNULL({row}.parsed = 0 AND {row}.invalid = 0 AND {row}.classification = 0
+    AND {row}.content_file IS NOT NULL, 0)"""
+
+
+# Keeps the fingerprint_band rows of a link in line with one of its
+# fingerprint columns, in 8 bands of 8 bits (see FINGERPRINT_BANDS in utils.py)
+FINGERPRINT_BAND_TRIGGER = """
+    CREATE TRIGGER IF NOT EXISTS fingerprint_{kind}_update
+    AFTER UPDATE OF {column} ON link
+    WHEN NEW.{column} IS NOT OLD.{column}
+    BEGIN
+        DELETE FROM fingerprint_band WHERE link_id = NEW.id AND kind = '{kind}';
+        INSERT INTO fingerprint_band (kind, band, value, link_id)
+        SELECT '{kind}', band, (NEW.{column} >> (8 * band)) & 255, NEW.id
+        FROM (
+            SELECT 0 AS band UNION ALL SELECT 1 UNION ALL SELECT 2 UNION ALL SELECT 3
+            UNION ALL SELECT 4 UNION ALL SELECT 5 UNION ALL SELECT 6 UNION ALL SELECT 7
+        )
+        WHERE NEW.{column} IS NOT NULL;
+    END
+"""
+
+
+# is_complete of a NEW/OLD row. The generated column can't be named in an
+# UPDATE OF trigger, so the columns it is computed from are used instead.
+COMPLETE = "IFNULL({row}.is_complete, 0) = 1"
+
+# Gives NEW a completion sequence number above every one handed out so far.
+# The number is kept if the link stops being complete, so it is never reused.
+NEXT_COMPLETED_SEQ = """
+    UPDATE link
+    SET completed_seq = (
+        SELECT IFNULL(MAX(completed_seq), 0) + 1 FROM link
+        WHERE completed_seq IS NOT NULL
+    )
+    WHERE id = NEW.id;
+"""
+
+# Gives NEW a lead sequence number above every one handed out so far
+NEXT_LEAD_SEQ = """
+    UPDATE lead
+    SET export_seq = (
+        SELECT IFNULL(MAX(export_seq), 0) + 1 FROM lead
+        WHERE export_seq IS NOT NULL
+    )
+    WHERE id = NEW.id;
+"""
+
+
+# Ordered list of (version, description, steps). A step is either a SQL
+# statement or a callable taking (conn, cursor). Never edit a migration that
+# has been released, add a new one instead.
+MIGRATIONS = [
+    (1, "Create base tables", [create_base_tables]),
+    (
+        2,
+        "Indexes for the hot link/sent/lead/worklog queries",
+        [
+            # db_get_links and db_get_unscraped_links
+            """
+            CREATE INDEX IF NOT EXISTS idx_link_unscraped
+            ON link(parsed, id, link)
+            WHERE content_file IS NULL AND invalid = 0
+            """,
+            # db_get_unparsed_links
+            """
+            CREATE INDEX IF NOT EXISTS idx_link_unparsed
+            ON link(id, content_file)
+            WHERE parsed = 0 AND invalid = 0 AND classification = 0
+            AND content_file IS NOT NULL
+            """,
+            # db_get_lead, db_get_lead_count_remainder and db_get_all_leads.
+            # The join on sent.domain uses the UNIQUE index of sent.domain.
+            """
+            CREATE INDEX IF NOT EXISTS idx_link_parsed
+            ON link(email, link)
+            WHERE parsed = 1
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_lead_campaign_id ON lead(campaign_id)",
+            "CREATE INDEX IF NOT EXISTS idx_worklog_user_id ON worklog(user_id)",
+        ],
+    ),
+    (
+        3,
+        "Review queue with reviewer leases",
+        [
+            # lease_expires_at is 0 for unclaimed links, so the next lead is
+            # the first entry of idx_review_queue_lease that has expired.
+            """
+            CREATE TABLE IF NOT EXISTS review_queue(
+                link_id INTEGER PRIMARY KEY,
+                leased_by INTEGER,
+                lease_expires_at INTEGER NOT NULL DEFAULT 0,
+                FOREIGN KEY (link_id) REFERENCES link(id),
+                FOREIGN KEY (leased_by) REFERENCES user(id))
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_review_queue_lease
+            ON review_queue(lease_expires_at, link_id)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_review_queue_leased_by
+            ON review_queue(leased_by, lease_expires_at)
+            WHERE leased_by IS NOT NULL
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS review_queue_link_insert
+            AFTER INSERT ON link
+            WHEN {REVIEWABLE.format(row="NEW")}
+            BEGIN
+                INSERT OR IGNORE INTO review_queue (link_id) VALUES (NEW.id);
+            END
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS review_queue_link_update
+            AFTER UPDATE OF link, email, parsed ON link
+            BEGIN
+                DELETE FROM review_queue
+                WHERE link_id = NEW.id AND NOT ({REVIEWABLE.format(row="NEW")});
+                INSERT OR IGNORE INTO review_queue (link_id)
+                SELECT NEW.id WHERE {REVIEWABLE.format(row="NEW")};
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS review_queue_link_delete
+            AFTER DELETE ON link
+            BEGIN
+                DELETE FROM review_queue WHERE link_id = OLD.id;
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS review_queue_sent_insert
+            AFTER INSERT ON sent
+            BEGIN
+                DELETE FROM review_queue
+                WHERE link_id IN (SELECT id FROM link WHERE link = NEW.domain);
+            END
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS review_queue_sent_delete
+            AFTER DELETE ON sent
+            BEGIN
+                INSERT OR IGNORE INTO review_queue (link_id)
+                SELECT id FROM link WHERE link = OLD.domain
+                AND {REVIEWABLE.format(row="link")};
+            END
+            """,
+            f"""
+            INSERT OR IGNORE INTO review_queue (link_id)
+            SELECT id FROM link WHERE {REVIEWABLE.format(row="link")}
+            """,
+        ],
+    ),
+    (
+        4,
+        "Trigger-maintained dashboard counters",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS stats(
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0)
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS campaign_stats(
+                campaign_id INTEGER PRIMARY KEY,
+                lead_count INTEGER NOT NULL DEFAULT 0,
+                FOREIGN KEY (campaign_id) REFERENCES campaign(id))
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS stats_link_insert
+            AFTER INSERT ON link
+            BEGIN
+                UPDATE stats SET value = value + {UNSCRAPED.format(row="NEW")}
+                WHERE name = 'total_unscraped_links';
+                UPDATE stats SET value = value + {UNPARSED.format(row="NEW")}
+                WHERE name = 'total_unparsed_links';
+            END
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS stats_link_update
+            AFTER UPDATE OF parsed, invalid, content_file, classification ON link
+            BEGIN
+                UPDATE stats
+                SET value = value + {UNSCRAPED.format(row="NEW")} - {UNSCRAPED.format(row="OLD")}
+                WHERE name = 'total_unscraped_links';
+                UPDATE stats
+                SET value = value + {UNPARSED.format(row="NEW")} - {UNPARSED.format(row="OLD")}
+                WHERE name = 'total_unparsed_links';
+            END
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS stats_link_delete
+            AFTER DELETE ON link
+            BEGIN
+                UPDATE stats SET value = value - {UNSCRAPED.format(row="OLD")}
+                WHERE name = 'total_unscraped_links';
+                UPDATE stats SET value = value - {UNPARSED.format(row="OLD")}
+                WHERE name = 'total_unparsed_links';
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS stats_review_queue_insert
+            AFTER INSERT ON review_queue
+            BEGIN
+                UPDATE stats SET value = value + 1 WHERE name = 'remaining_leads';
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS stats_review_queue_delete
+            AFTER DELETE ON review_queue
+            BEGIN
+                UPDATE stats SET value = value - 1 WHERE name = 'remaining_leads';
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS stats_lead_insert
+            AFTER INSERT ON lead
+            BEGIN
+                UPDATE stats SET value = value + 1 WHERE name = 'total_leads';
+                INSERT INTO campaign_stats (campaign_id, lead_count)
+                SELECT NEW.campaign_id, 1 WHERE NEW.campaign_id IS NOT NULL
+                ON CONFLICT (campaign_id) DO UPDATE SET lead_count = lead_count + 1;
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS stats_lead_delete
+            AFTER DELETE ON lead
+            BEGIN
+                UPDATE stats SET value = value - 1 WHERE name = 'total_leads';
+                UPDATE campaign_stats SET lead_count = lead_count - 1
+                WHERE campaign_id = OLD.campaign_id;
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS stats_lead_update
+            AFTER UPDATE OF campaign_id ON lead
+            WHEN NEW.campaign_id IS NOT OLD.campaign_id
+            BEGIN
+                UPDATE campaign_stats SET lead_count = lead_count - 1
+                WHERE campaign_id = OLD.campaign_id;
+                INSERT INTO campaign_stats (campaign_id, lead_count)
+                SELECT NEW.campaign_id, 1 WHERE NEW.campaign_id IS NOT NULL
+                ON CONFLICT (campaign_id) DO UPDATE SET lead_count = lead_count + 1;
+            END
+            """,
+            rebuild_stats,
+        ],
+    ),
+    (
+        5,
+        "Normalized 'None' values and is_complete flag on link",
+        [
+            normalize_link_values,
+            """
+            ALTER TABLE link ADD COLUMN is_complete INTEGER
+            GENERATED ALWAYS AS (
+                parsed = 1 AND email IS NOT NULL AND area IS NOT NULL
+                AND contact_name IS NOT NULL
+            ) VIRTUAL
+            """,
+            # db_get_all_leads and db_delete_all_leads
+            """
+            CREATE INDEX IF NOT EXISTS idx_link_complete
+            ON link(id) WHERE is_complete = 1
+            """,
+        ],
+    ),
+    (
+        6,
+        "Watermarks for delta exports",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS export_watermark(
+                name TEXT PRIMARY KEY,
+                last_id INTEGER NOT NULL,
+                exported_at TEXT DEFAULT CURRENT_TIMESTAMP)
+            """,
+        ],
+    ),
+    (
+        7,
+        "Text and screenshot fingerprints for near-duplicate lookups",
+        [
+            "ALTER TABLE link ADD COLUMN text_hash INTEGER",
+            "ALTER TABLE link ADD COLUMN text_digest TEXT",
+            "ALTER TABLE link ADD COLUMN image_hash INTEGER",
+            """
+            CREATE TABLE IF NOT EXISTS fingerprint_band(
+                kind TEXT NOT NULL,
+                band INTEGER NOT NULL,
+                value INTEGER NOT NULL,
+                link_id INTEGER NOT NULL,
+                PRIMARY KEY (kind, band, value, link_id)) WITHOUT ROWID
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_fingerprint_band_link_id
+            ON fingerprint_band(link_id)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_link_text_digest
+            ON link(text_digest) WHERE text_digest IS NOT NULL
+            """,
+            FINGERPRINT_BAND_TRIGGER.format(kind="text", column="text_hash"),
+            FINGERPRINT_BAND_TRIGGER.format(kind="image", column="image_hash"),
+            """
+            CREATE TRIGGER IF NOT EXISTS fingerprint_link_delete
+            AFTER DELETE ON link
+            BEGIN
+                DELETE FROM fingerprint_band WHERE link_id = OLD.id;
+            END
+            """,
+        ],
+    ),
+    (
+        8,
+        "Completion sequence for delta exports of links",
+        [
+            "ALTER TABLE link ADD COLUMN completed_seq INTEGER",
+            # Links complete before this migration keep their id, so the
+            # stored 'all' watermark still covers what was exported by id
+            "UPDATE link SET completed_seq = id WHERE is_complete = 1",
+            """
+            CREATE INDEX IF NOT EXISTS idx_link_completed_seq
+            ON link(completed_seq) WHERE completed_seq IS NOT NULL
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS completed_seq_link_insert
+            AFTER INSERT ON link
+            WHEN {COMPLETE.format(row="NEW")}
+            BEGIN
+                {NEXT_COMPLETED_SEQ}
+            END
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS completed_seq_link_update
+            AFTER UPDATE OF parsed, email, area, contact_name ON link
+            WHEN {COMPLETE.format(row="NEW")} AND NOT {COMPLETE.format(row="OLD")}
+            BEGIN
+                {NEXT_COMPLETED_SEQ}
+            END
+            """,
+        ],
+    ),
+    (
+        9,
+        "Lead sequence for campaign delta exports",
+        [
+            # A lead moved to another campaign gets a new number, so a delta
+            # export of that campaign picks it up like a new lead
+            "ALTER TABLE lead ADD COLUMN export_seq INTEGER",
+            "UPDATE lead SET export_seq = id",
+            """
+            CREATE INDEX IF NOT EXISTS idx_lead_export_seq
+            ON lead(export_seq) WHERE export_seq IS NOT NULL
+            """,
+            # db_iter_leads and db_get_max_lead_seq
+            """
+            CREATE INDEX IF NOT EXISTS idx_lead_campaign_export_seq
+            ON lead(campaign_id, export_seq)
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS export_seq_lead_insert
+            AFTER INSERT ON lead
+            BEGIN
+                {NEXT_LEAD_SEQ}
+            END
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS export_seq_lead_update
+            AFTER UPDATE OF campaign_id ON lead
+            WHEN NEW.campaign_id IS NOT OLD.campaign_id
+            BEGIN
+                {NEXT_LEAD_SEQ}
+            END
+            """,
+        ],
+    ),
+]
+
+
+@connection
+def get_schema_version(conn=None, cursor=None):
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_version(
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TEXT DEFAULT CURRENT_TIMESTAMP)
+        """
+    )
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    version = cursor.fetchone()[0]
+    return version or 0
+
+
+@connection
+def run_migrations(conn=None, cursor=None):
+    """
+    Apply every migration newer than the current schema version.
+
+    Each migration runs in its own transaction together with the bump of
+    schema_version. BEGIN IMMEDIATE takes the write lock up front, so when
+    several gunicorn workers start at once only one of them applies a given
+    migration and the others see it as done.
+
+    :return: List of the versions applied.
+    """
+    current_version = get_schema_version(conn=conn)
+
+    applied = []
+    for version, description, steps in MIGRATIONS:
+        if version <= current_version:
+            continue
+
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(conn=conn) >= version:
+                conn.rollback()
+                continue
+
+            print(f"Applying migration {version}: {description}")
+            for step in steps:
+                if callable(step):
+                    step(conn, cursor)
+                else:
+                    cursor.execute(step)
+
+            cursor.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description),
+            )
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logging.error(f"Migration {version} failed: {e}")
+            raise
+
+        logging.info(f"Applied migration {version}: {description}")
+        applied.append(version)
+
+    return applied
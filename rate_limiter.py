@@ -0,0 +1,148 @@
+import re
+import time
+import asyncio
+import logging
+
+# Durations in OpenAI rate limit headers, e.g. '1s', '6m0s', '20ms'
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: str) -> float:
+    """Parse a duration like '6m0s' into seconds"""
+    if not value:
+        return 0.0
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    return sum(
+        float(amount) * DURATION_UNITS[unit]
+        for amount, unit in DURATION_PATTERN.findall(value)
+    )
+
+
+class TokenBucket:
+    """A bucket holding up to `per_minute` units that refills continuously"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until `amount` units are available"""
+        self.refill()
+        # Requests larger than the bucket only wait for a full bucket
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def consume(self, amount: float):
+        self.refill()
+        self.level -= amount
+
+    def limit(self, remaining: float):
+        """Lower the level to what the server says is left"""
+        self.refill()
+        self.level = min(self.level, remaining)
+
+
+class RateLimiter:
+    """
+    Requests- and tokens-per-minute limiter for the LLM API.
+
+    Callers acquire() before every request, one at a time in arrival order.
+    The buckets are kept in line with the x-ratelimit-* response headers,
+    and a 429 pauses all callers until the server's reset time while the
+    rates are lowered, recovering gradually on successful requests.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float,
+        tokens_per_minute: float,
+        decrease: float = 0.8,
+        recovery: float = 1.01,
+    ):
+        self.max_requests_per_minute = requests_per_minute
+        self.max_tokens_per_minute = tokens_per_minute
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.decrease = decrease
+        self.recovery = recovery
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int):
+        """Wait until a request estimated at `tokens` tokens may be sent"""
+        async with self.lock:
+            while True:
+                wait = max(
+                    self.paused_until - time.monotonic(),
+                    self.requests.delay(1),
+                    self.tokens.delay(tokens),
+                )
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            self.requests.consume(1)
+            self.tokens.consume(tokens)
+
+    def record_usage(self, estimated: int, used: int):
+        """Correct the token bucket with the usage reported by the API"""
+        self.tokens.consume(used - estimated)
+
+    def update(self, headers):
+        """Sync the buckets with the rate limit headers of a successful response"""
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        if remaining_requests is not None:
+            self.requests.limit(float(remaining_requests))
+
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_tokens is not None:
+            self.tokens.limit(float(remaining_tokens))
+
+        self._set_rates(
+            min(
+                self.max_requests_per_minute,
+                self.requests.capacity * self.recovery,
+            ),
+            min(self.max_tokens_per_minute, self.tokens.capacity * self.recovery),
+        )
+
+    def rate_limited(self, headers=None, default_delay: float = 5.0):
+        """Pause all requests and lower the rates after a 429 response"""
+        headers = headers or {}
+        delay = max(
+            parse_duration(headers.get("retry-after")),
+            parse_duration(headers.get("x-ratelimit-reset-requests")),
+            parse_duration(headers.get("x-ratelimit-reset-tokens")),
+        )
+        delay = delay or default_delay
+
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        self._set_rates(
+            self.requests.capacity * self.decrease,
+            self.tokens.capacity * self.decrease,
+        )
+        logging.warning(
+            f"Rate limited, pausing {delay:.1f}s at "
+            f"{self.requests.capacity:.0f} requests/min, {self.tokens.capacity:.0f} tokens/min"
+        )
+
+    def _set_rates(self, requests_per_minute: float, tokens_per_minute: float):
+        for bucket, per_minute in (
+            (self.requests, requests_per_minute),
+            (self.tokens, tokens_per_minute),
+        ):
+            bucket.refill()
+            bucket.capacity = per_minute
+            bucket.rate = per_minute / 60
+            bucket.level = min(bucket.level, per_minute)
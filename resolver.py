@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# getaddrinfo errors meaning the name doesn't exist, as opposed to e.g.
+# EAI_AGAIN which is a temporary failure
+NXDOMAIN_ERRORS = {
+    getattr(socket, name)
+    for name in ("EAI_NONAME", "EAI_NODATA")
+    if hasattr(socket, name)
+}
+
+
+async def system_resolver(domain: str):
+    """
+    Resolve a domain with the system resolver, off the event loop.
+
+    :return: True when it resolves, False when it doesn't exist, None when
+    the lookup failed for another reason.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.getaddrinfo(domain, 80, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        if e.errno in NXDOMAIN_ERRORS:
+            return False
+        logging.info(f"DNS lookup failed for {domain}: {e}")
+        return None
+    except UnicodeError:
+        # Not a valid hostname
+        return False
+    return True
+
+
+class StubResolver:
+    """Resolver answering from a dict of domain: True/False, for trying things out"""
+
+    def __init__(self, answers: dict, default=False):
+        self.answers = answers
+        self.default = default
+
+    async def __call__(self, domain: str):
+        return self.answers.get(domain, self.default)
+
+
+class DnsCache:
+    """
+    Domains that resolved, kept for `ttl` seconds.
+
+    Saved to a JSON file when a path is given, so a rerun doesn't look up
+    the same domains again. Failures are never cached, a domain may be
+    registered by the next run.
+    """
+
+    def __init__(self, path: str = None, ttl: float = 3600):
+        self.path = path
+        self.ttl = ttl
+        self.expires = {}
+
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                self.expires = json.load(file)
+
+    def __contains__(self, domain: str) -> bool:
+        return self.expires.get(domain, 0) > time.time()
+
+    def add(self, domain: str):
+        self.expires[domain] = time.time() + self.ttl
+
+    def save(self):
+        if not self.path:
+            return
+        now = time.time()
+        with open(self.path, "w", encoding="utf-8") as file:
+            json.dump(
+                {domain: at for domain, at in self.expires.items() if at > now}, file
+            )
+
+
+async def filter_resolvable(
+    links: list, concurrency: int = 100, resolver=None, cache: DnsCache = None
+):
+    """
+    Split links into the ones whose domain resolves and the ones that don't.
+
+    Lookups run concurrently, at most `concurrency` at a time. Links whose
+    lookup failed for another reason than a missing domain are kept.
+
+    :param links: (id, link) records.
+    :param resolver: Async callable like system_resolver.
+    :return: The (id, link) records to scrape and the ids of dead links.
+    """
+    if resolver is None:
+        resolver = system_resolver
+        # getaddrinfo blocks a thread of the loop's default executor per
+        # lookup, which holds only a few dozen threads by default
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=concurrency)
+        )
+    cache = cache if cache is not None else DnsCache()
+    semaphore = asyncio.Semaphore(concurrency)
+    answers = {}
+
+    async def resolve(domain):
+        if domain in cache:
+            answers[domain] = True
+            return
+        async with semaphore:
+            answers[domain] = await resolver(domain)
+        if answers[domain]:
+            cache.add(domain)
+
+    await asyncio.gather(*(resolve(domain) for domain in {link for _, link in links}))
+    cache.save()
+
+    alive = [(id, link) for id, link in links if answers[link] is not False]
+    dead = [id for id, link in links if answers[link] is False]
+    return alive, dead
@@ -1,57 +1,40 @@
+import json
+
 from flask import Blueprint, request, jsonify
 
 from database import (
     db_update_link_record,
+    db_update_link_records,
     db_get_sent,
+    db_get_sent_batch,
+    db_create_sent_bulk,
     db_create_link,
+    db_create_links_bulk,
     db_get_links,
     db_get_unparsed_links,
     db_create_user,
     db_get_campaigns,
+    db_find_similar_link,
+    LINK_UPDATE_COLUMNS,
 )
 
 routes_blueprint = Blueprint("routes_blueprint", __name__)
 
 
+def get_link_update_args(data: dict) -> dict:
+    """Take the provided link fields, values are normalized by the database layer"""
+    return {key: data[key] for key in LINK_UPDATE_COLUMNS if data.get(key) is not None}
+
+
 @routes_blueprint.route("/update_link/<int:link_id>", methods=["POST"])
 def update_link(link_id):
     try:
         data = request.json
 
-        # Prepare a dictionary of arguments
-        args = {
-            "link_id": link_id,
-            "link": data.get("link"),
-            "content_file": data.get("content_file"),
-            "email": data.get("email", "").lower()
-            if data.get("email") is not None
-            else None,
-            "contact_name": data.get("contact_name", "").title()
-            if data.get("contact_name") is not None
-            else None,
-            "pronoun": data.get("pronoun"),
-            "industry": data.get("industry", "").title()
-            if data.get("industry") is not None
-            else None,
-            "city": data.get("city", "").title()
-            if data.get("city") is not None
-            else None,
-            "area": data.get("area", "").title()
-            if data.get("area") is not None
-            else None,
-            "parsed": data.get("parsed"),
-            "invalid": data.get("invalid"),
-            "contacted_at": data.get("contacted_at"),
-            "classification": data.get("classification")
-            if data.get("classification") is not None
-            else None,
-        }
-
-        # Remove None values
-        args = {k: v for k, v in args.items() if v is not None}
+        args = get_link_update_args(data)
 
         # Call the function with unpacked arguments
-        db_update_link_record(**args)
+        db_update_link_record(link_id=link_id, **args)
 
         return jsonify({"message": "Link updated successfully"}), 200
 
@@ -59,6 +42,25 @@ def update_link(link_id):
         return jsonify({"error": str(e)}), 500
 
 
+@routes_blueprint.route("/update_links", methods=["POST"])
+def update_links():
+    try:
+        updates = [
+            {"id": int(item["id"]), **get_link_update_args(item)}
+            for item in request.json
+        ]
+
+        updated = db_update_link_records(updates=updates)
+
+        return (
+            jsonify({"message": "Links updated successfully", "updated": updated}),
+            200,
+        )
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
 @routes_blueprint.route("/check_sent", methods=["POST"])
 def check_sent():
     data = request.json
@@ -68,6 +70,15 @@ def check_sent():
     return jsonify({"sent": result})
 
 
+@routes_blueprint.route("/check_sent/batch", methods=["POST"])
+def check_sent_batch():
+    data = request.json
+    domains = data.get("domains") or []
+    emails = data.get("emails") or []
+    result = db_get_sent_batch(domains=domains, emails=emails)
+    return jsonify({key: sorted(values) for key, values in result.items()})
+
+
 @routes_blueprint.route("/create_link", methods=["POST"])
 def create_link():
     data = request.json
@@ -76,6 +87,67 @@ def create_link():
     return jsonify({"message": "Link created successfully"}), 200
 
 
+def iter_request_links():
+    """
+    Yield the links of a bulk request.
+
+    The body is either a JSON array of strings or, with an
+    application/x-ndjson content type, one JSON string per line which is
+    read as it streams in.
+
+    :raises ValueError: When the body isn't a list of strings.
+    """
+    if request.mimetype == "application/x-ndjson":
+        items = (json.loads(line) for line in request.stream if line.strip())
+    else:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            raise ValueError("expected a JSON array of links")
+
+    for item in items:
+        if not isinstance(item, str):
+            raise ValueError(f"expected a link string, got {json.dumps(item)}")
+        if item.strip():
+            yield item.strip()
+
+
+@routes_blueprint.route("/links/bulk", methods=["POST"])
+def create_links_bulk():
+    try:
+        counts = db_create_links_bulk(links=iter_request_links())
+    except (ValueError, TypeError, AttributeError) as e:
+        return jsonify({"error": f"Invalid body: {e}"}), 400
+
+    return jsonify(counts), 200
+
+
+@routes_blueprint.route("/sent/bulk", methods=["POST"])
+def create_sent_bulk():
+    # Same body as /links/bulk, a list of domains
+    try:
+        counts = db_create_sent_bulk(domains=iter_request_links())
+    except (ValueError, TypeError, AttributeError) as e:
+        return jsonify({"error": f"Invalid body: {e}"}), 400
+
+    return jsonify(counts), 200
+
+
+@routes_blueprint.route("/links/similar", methods=["GET"])
+def get_similar_link():
+    try:
+        link = db_find_similar_link(
+            kind=request.args["kind"],
+            fingerprint=int(request.args["fingerprint"]),
+            max_distance=int(request.args.get("max_distance", 6)),
+            exclude_id=request.args.get("exclude_id", type=int),
+            digest=request.args.get("digest"),
+        )
+    except (KeyError, ValueError) as e:
+        return jsonify({"error": f"Invalid query: {e}"}), 400
+
+    return jsonify({"link": link}), 200
+
+
 @routes_blueprint.route("/links", methods=["GET"])
 def get_links():
     links = db_get_links()
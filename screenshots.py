@@ -0,0 +1,53 @@
+import io
+import math
+
+from PIL import Image
+
+
+def prepare_screenshot(
+    image_path: str, width: int = 1024, max_height: int = 1536, quality: int = 70
+):
+    """
+    Shrink a screenshot for classification.
+
+    The image is scaled down to `width`, cropped to `max_height` from the
+    top (the part of the page a visitor sees first) and encoded as JPEG.
+    Runs in a worker process, so it only takes and returns plain values.
+
+    :return: JPEG bytes and the (width, height) of the result.
+    """
+    with Image.open(image_path) as image:
+        image = image.convert("RGB")
+
+        if image.width > width:
+            height = round(image.height * width / image.width)
+            # reduce() does the bulk of the downscaling fast, resize() the rest
+            factor = image.width // width
+            if factor > 1:
+                image = image.reduce(factor)
+            image = image.resize((width, height), Image.LANCZOS)
+
+        if image.height > max_height:
+            image = image.crop((0, 0, image.width, max_height))
+
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=quality, optimize=True)
+        return buffer.getvalue(), image.size
+
+
+def estimate_image_tokens(width: int, height: int, detail: str = "high") -> int:
+    """
+    Tokens the vision model counts for an image.
+
+    Low detail is a flat 85 tokens. High detail fits the image in 2048x2048,
+    scales the short side down to 768 and counts 170 per 512px tile plus 85.
+    """
+    if detail == "low":
+        return 85
+
+    scale = min(1, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1, 768 / min(width, height))
+    width, height = width * scale, height * scale
+
+    return 170 * math.ceil(width / 512) * math.ceil(height / 512) + 85
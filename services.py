@@ -1,8 +1,19 @@
 import os
-
+import json
+import time
+import asyncio
+import atexit
+import random
+import logging
+import threading
+
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
+from utils import chunked
+
 load_dotenv()
 
 api_endpoint = os.getenv("API_ENDPOINT")
@@ -12,116 +23,554 @@ print(f"Connecting to: {api_endpoint}")
 if not api_endpoint:
     raise Exception("You need to add API_ENDPOINT to the environment")
 
-
-def update_link_record(
-    link_id: int,
-    content_file: str = None,
-    email: str = None,
-    contact_name: str = None,
-    pronoun: str = None,
-    industry: str = None,
-    city: str = None,
-    area: str = None,
-    parsed: int = 0,
-    invalid: int = 0,
-    classification: int = None,
-):
-    url = f"http://{api_endpoint}/api/update_link/{link_id}"
-
-    data = {
-        "content_file": content_file,
-        "email": email,
-        "contact_name": contact_name,
-        "pronoun": pronoun,
-        "industry": industry,
-        "city": city,
-        "area": area,
-        "parsed": parsed,
-        "invalid": invalid,
-        "classification": classification,
-    }
-
-    response = requests.post(url, json=data)
-
-    if response.status_code == 200:
-        return
-    else:
-        raise Exception("Bad request")
-
-
-def check_sent(domain: str = None, email: str = None):
-    url = f"http://{api_endpoint}/api/check_sent"
-
-    data = {"domain": domain, "email": email}
-
-    response = requests.post(url, json=data)
-    if response.status_code == 200:
-        data = response.json()
-        return data["sent"]
-    else:
-        raise Exception("Bad request")
-
-
-def create_link(link: str):
-    url = f"http://{api_endpoint}/api/create_link"
-
-    data = {"link": link}
-
-    response = requests.post(url, json=data)
-    if response.status_code == 200:
-        return
-    else:
-        raise Exception("Bad request")
-
-
-def get_links():
-    url = f"http://{api_endpoint}/api/links"
-
-    response = requests.get(url)
-    if response.status_code == 200:
-        data = response.json()
-        return data["links"]
-    else:
-        raise Exception("Bad request")
-
-
-def get_links_for_parsing():
-    # Get all links ready for AI parser
-    url = f"http://{api_endpoint}/api/links_for_parsing"
-
-    response = requests.get(url)
-    if response.status_code == 200:
-        data = response.json()
-        return data["links"]
-    else:
-        raise Exception("Bad request")
-
-
-def get_campaigns():
-    # Get all links ready for AI parser
-    url = f"http://{api_endpoint}/api/campaigns"
-
-    response = requests.get(url)
-    if response.status_code == 200:
-        data = response.json()
-        return data["campaigns"]
-    else:
-        raise Exception("Bad request")
-
-
-def create_user(username: str, password: str, superuser: bool):
-    # Get all links ready for AI parser
-    url = f"http://{api_endpoint}/api/create_user"
-
-    data = {
-        "username": username,
-        "password": password,
-        "superuser": superuser,
-    }
-
-    response = requests.post(url, json=data)
-
-    if response.status_code == 200:
-        return
-    else:
-        raise Exception("Bad request")
+api_pool_size = int(os.getenv("API_POOL_SIZE", "10"))
+api_timeout = float(os.getenv("API_TIMEOUT", "30"))
+api_retries = int(os.getenv("API_RETRIES", "5"))
+
+
+# Answers that mean the server is busy or restarting, as opposed to the
+# request itself failing (the routes answer 500 for that)
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+class ApiError(Exception):
+    """The API answered with an error or could not be reached"""
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+    """Exponential backoff with full jitter for the given (0-based) retry"""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def sum_counts(results: list) -> dict:
+    """Add up the count dictionaries returned by chunked requests"""
+    counts = {}
+    for result in results:
+        for key, value in result.items():
+            counts[key] = counts.get(key, 0) + value
+    return counts
+
+
+class BaseApiClient:
+    """
+    Endpoints and retry rules of the leadtool API.
+
+    Subclasses only add the transport: request() sends a request with the
+    retry rules below, call() sends one and parses the answer, call_each()
+    sends a series of them and combines the answers. The endpoint methods
+    return whatever call() returns, so they are awaitable on an async
+    client.
+
+    Connection errors, timeouts and RETRY_STATUSES are retried with jittered
+    exponential backoff, any other non-200 response raises ApiError straight
+    away. POST requests are only retried when the call is idempotent,
+    otherwise a retry could repeat something that already happened.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        timeout: float = 30.0,
+        retries: int = 5,
+        backoff: float = 0.5,
+        max_backoff: float = 30.0,
+    ):
+        self.base_url = f"http://{endpoint}/api"
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def attempts(self, method: str, idempotent: bool = None) -> int:
+        """
+        Number of times a request may be sent.
+
+        :param idempotent: Whether the request may be sent again, by default
+            everything but POST.
+        """
+        if idempotent is None:
+            idempotent = method != "POST"
+        return self.retries + 1 if idempotent else 1
+
+    def check_response(self, method: str, path: str, status_code: int):
+        """
+        Return None for a successful answer and the error for one worth
+        retrying, raise ApiError for any other.
+        """
+        if status_code == 200:
+            return None
+        if status_code not in RETRY_STATUSES:
+            raise ApiError(f"Bad request: {method} {path} returned {status_code}")
+        return ApiError(f"{method} {path} returned {status_code}")
+
+    def retry_delay(self, method: str, path: str, attempt: int, error) -> float:
+        delay = backoff_delay(attempt, self.backoff, self.max_backoff)
+        logging.warning(f"{method} {path} failed ({error}), retrying in {delay:.1f}s")
+        return delay
+
+    def give_up(self, method: str, path: str, attempts: int, error) -> ApiError:
+        return ApiError(f"{method} {path} failed after {attempts} attempts: {error}")
+
+    def update_link_record(
+        self,
+        link_id: int,
+        content_file: str = None,
+        email: str = None,
+        contact_name: str = None,
+        pronoun: str = None,
+        industry: str = None,
+        city: str = None,
+        area: str = None,
+        parsed: int = 0,
+        invalid: int = 0,
+        classification: int = None,
+    ):
+        data = {
+            "content_file": content_file,
+            "email": email,
+            "contact_name": contact_name,
+            "pronoun": pronoun,
+            "industry": industry,
+            "city": city,
+            "area": area,
+            "parsed": parsed,
+            "invalid": invalid,
+            "classification": classification,
+        }
+
+        # Sets absolute values, so sending it twice does no harm
+        return self.call("POST", f"/update_link/{link_id}", json=data, idempotent=True)
+
+    def update_links(self, updates: list):
+        """
+        Apply many partial link updates in one request.
+
+        :param updates: Dictionaries with the link 'id' and the fields to set.
+        :return: Number of links updated.
+        """
+        return self.call(
+            "POST",
+            "/update_links",
+            json=updates,
+            # Sets absolute values, so sending it twice does no harm
+            idempotent=True,
+            parse=lambda response: response.json()["updated"],
+        )
+
+    def check_sent(self, domain: str = None, email: str = None):
+        data = {"domain": domain, "email": email}
+
+        return self.call(
+            "POST",
+            "/check_sent",
+            json=data,
+            idempotent=True,
+            parse=lambda response: response.json()["sent"],
+        )
+
+    def check_sent_batch(
+        self, domains: list = None, emails: list = None, batch_size=5000
+    ):
+        """Return the sets of domains and emails that have already been sent to"""
+        calls = (
+            dict(
+                method="POST",
+                path="/check_sent/batch",
+                json={key: chunk},
+                idempotent=True,
+                parse=lambda response, key=key: (key, response.json()[key]),
+            )
+            for key, values in (("domains", domains or []), ("emails", emails or []))
+            for chunk in chunked(values, batch_size)
+        )
+
+        def combine(results):
+            sent = {"domains": set(), "emails": set()}
+            for key, values in results:
+                sent[key].update(values)
+            return sent
+
+        return self.call_each(calls, combine=combine)
+
+    def create_link(self, link: str):
+        # An existing link is ignored, so sending it twice does no harm
+        return self.call("POST", "/create_link", json={"link": link}, idempotent=True)
+
+    def create_links_bulk(self, links: list, batch_size=10000):
+        """
+        Create many links, skipping duplicates and domains already sent to.
+
+        :return: Dictionary with the 'inserted', 'duplicate' and 'sent' counts.
+        """
+        headers = {"Content-Type": "application/x-ndjson"}
+
+        calls = (
+            dict(
+                method="POST",
+                path="/links/bulk",
+                content="".join(json.dumps(link) + "\n" for link in chunk).encode(
+                    "utf-8"
+                ),
+                headers=headers,
+                # Links already there are ignored, so a repeated chunk does no harm
+                idempotent=True,
+                parse=lambda response: response.json(),
+            )
+            for chunk in chunked(links, batch_size)
+        )
+
+        return self.call_each(
+            calls,
+            combine=lambda results: {
+                "inserted": 0,
+                "duplicate": 0,
+                "sent": 0,
+                **sum_counts(results),
+            },
+        )
+
+    def create_sent_bulk(self, domains: list, batch_size=10000):
+        """
+        Record many domains as sent to.
+
+        :return: Dictionary with the 'inserted' and 'duplicate' counts.
+        """
+        calls = (
+            dict(
+                method="POST",
+                path="/sent/bulk",
+                json=chunk,
+                # Domains already there are ignored
+                idempotent=True,
+                parse=lambda response: response.json(),
+            )
+            for chunk in chunked(domains, batch_size)
+        )
+
+        return self.call_each(
+            calls,
+            combine=lambda results: {
+                "inserted": 0,
+                "duplicate": 0,
+                **sum_counts(results),
+            },
+        )
+
+    def get_links(self):
+        return self.call(
+            "GET", "/links", parse=lambda response: response.json()["links"]
+        )
+
+    def get_links_for_parsing(self):
+        # Get all links ready for AI parser
+        return self.call(
+            "GET",
+            "/links_for_parsing",
+            parse=lambda response: response.json()["links"],
+        )
+
+    def get_campaigns(self):
+        return self.call(
+            "GET", "/campaigns", parse=lambda response: response.json()["campaigns"]
+        )
+
+    def get_similar_link(
+        self,
+        kind: str,
+        fingerprint: int,
+        max_distance: int = 6,
+        exclude_id=None,
+        digest: str = None,
+    ):
+        """Closest processed link with the same text digest or a similar fingerprint"""
+        params = {
+            "kind": kind,
+            "fingerprint": fingerprint,
+            "max_distance": max_distance,
+        }
+        if exclude_id is not None:
+            params["exclude_id"] = exclude_id
+        if digest is not None:
+            params["digest"] = digest
+        return self.call(
+            "GET",
+            "/links/similar",
+            params=params,
+            parse=lambda response: response.json()["link"],
+        )
+
+    def create_user(self, username: str, password: str, superuser: bool):
+        data = {
+            "username": username,
+            "password": password,
+            "superuser": superuser,
+        }
+
+        return self.call("POST", "/create_user", json=data)
+
+
+class ApiClient(BaseApiClient):
+    """Client for the leadtool API over one pooled keep-alive requests session"""
+
+    def __init__(self, endpoint: str, pool_size: int = 10, **kwargs):
+        super().__init__(endpoint, **kwargs)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(
+        self, method: str, path: str, idempotent: bool = None, **kwargs
+    ) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        if "content" in kwargs:
+            kwargs["data"] = kwargs.pop("content")
+        attempts = self.attempts(method, idempotent)
+
+        for attempt in range(attempts):
+            try:
+                response = self.session.request(method, self.base_url + path, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            else:
+                error = self.check_response(method, path, response.status_code)
+                if error is None:
+                    return response
+
+            if attempt + 1 < attempts:
+                time.sleep(self.retry_delay(method, path, attempt, error))
+
+        raise self.give_up(method, path, attempts, error) from error
+
+    def call(self, method: str, path: str, parse=None, **kwargs):
+        response = self.request(method, path, **kwargs)
+        return parse(response) if parse else None
+
+    def call_each(self, calls, combine):
+        return combine([self.call(**call) for call in calls])
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncApiClient(BaseApiClient):
+    """
+    asyncio client for the leadtool API.
+
+    Uses a pooled httpx.AsyncClient, so API calls can overlap with other
+    coroutines (e.g. in-flight LLM requests) instead of blocking the event
+    loop. The endpoint methods return coroutines.
+    """
+
+    def __init__(self, endpoint: str, pool_size: int = 10, **kwargs):
+        super().__init__(endpoint, **kwargs)
+
+        self.client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(
+                max_connections=pool_size, max_keepalive_connections=pool_size
+            ),
+        )
+
+    async def request(
+        self, method: str, path: str, idempotent: bool = None, **kwargs
+    ) -> httpx.Response:
+        attempts = self.attempts(method, idempotent)
+
+        for attempt in range(attempts):
+            try:
+                response = await self.client.request(
+                    method, self.base_url + path, **kwargs
+                )
+            except httpx.TransportError as e:
+                error = e
+            else:
+                error = self.check_response(method, path, response.status_code)
+                if error is None:
+                    return response
+
+            if attempt + 1 < attempts:
+                await asyncio.sleep(self.retry_delay(method, path, attempt, error))
+
+        raise self.give_up(method, path, attempts, error) from error
+
+    async def call(self, method: str, path: str, parse=None, **kwargs):
+        response = await self.request(method, path, **kwargs)
+        return parse(response) if parse else None
+
+    async def call_each(self, calls, combine):
+        return combine([await self.call(**call) for call in calls])
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+
+# Shared client used by the module level functions below
+api = ApiClient(
+    api_endpoint, pool_size=api_pool_size, timeout=api_timeout, retries=api_retries
+)
+
+update_link_record = api.update_link_record
+update_links = api.update_links
+check_sent = api.check_sent
+check_sent_batch = api.check_sent_batch
+create_link = api.create_link
+create_links_bulk = api.create_links_bulk
+create_sent_bulk = api.create_sent_bulk
+get_links = api.get_links
+get_links_for_parsing = api.get_links_for_parsing
+get_campaigns = api.get_campaigns
+get_similar_link = api.get_similar_link
+create_user = api.create_user
+
+
+def create_async_client() -> AsyncApiClient:
+    """AsyncApiClient configured like the shared client, create it inside the event loop"""
+    return AsyncApiClient(
+        api_endpoint, pool_size=api_pool_size, timeout=api_timeout, retries=api_retries
+    )
+
+
+class BaseLinkUpdateBuffer:
+    """
+    Collects link updates to send them to the API in bulk.
+
+    Updates of the same link are merged, later values win. The buffer is
+    due once it holds `max_size` links, or on the first update after
+    `max_interval` seconds since the last send. Subclasses do the sending.
+    """
+
+    def __init__(self, client, max_size: int = 200, max_interval: float = 5.0):
+        self.client = client
+        self.max_size = max_size
+        self.max_interval = max_interval
+        self.updates = {}
+        self.lock = threading.Lock()
+        self.last_flush = time.monotonic()
+
+    def _queue(self, link_id: int, fields: dict) -> bool:
+        """Queue an update of a link and return whether the buffer is due"""
+        fields = {key: value for key, value in fields.items() if value is not None}
+
+        with self.lock:
+            self.updates.setdefault(link_id, {}).update(fields)
+            return (
+                len(self.updates) >= self.max_size
+                or time.monotonic() - self.last_flush >= self.max_interval
+            )
+
+    def _take(self) -> list:
+        """Empty the buffer and return its updates in the form of update_links"""
+        with self.lock:
+            updates, self.updates = self.updates, {}
+            self.last_flush = time.monotonic()
+        return [{"id": link_id, **fields} for link_id, fields in updates.items()]
+
+    def _put_back(self, updates: list):
+        """Queue updates that failed to send again, newer updates queued meanwhile win"""
+        with self.lock:
+            for update in updates:
+                link_id = update["id"]
+                fields = {key: value for key, value in update.items() if key != "id"}
+                self.updates[link_id] = {**fields, **self.updates.get(link_id, {})}
+
+
+class LinkUpdateBuffer(BaseLinkUpdateBuffer):
+    """
+    Sends link updates to the API in bulk, see BaseLinkUpdateBuffer.
+
+    add() sends the updates itself when the buffer is due. The buffer is
+    also flushed on close and at exit.
+    """
+
+    def __init__(
+        self, max_size: int = 200, max_interval: float = 5.0, client: ApiClient = None
+    ):
+        super().__init__(client or api, max_size=max_size, max_interval=max_interval)
+        atexit.register(self.flush)
+
+    def add(self, link_id: int, **fields):
+        """Queue an update of a link, fields set to None are left untouched"""
+        if self._queue(link_id, fields):
+            self.flush()
+
+    def flush(self):
+        """Send all queued updates"""
+        updates = self._take()
+        if not updates:
+            return
+
+        try:
+            self.client.update_links(updates)
+        except Exception:
+            self._put_back(updates)
+            raise
+
+    def close(self):
+        self.flush()
+        atexit.unregister(self.flush)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncLinkUpdateBuffer(BaseLinkUpdateBuffer):
+    """
+    Sends link updates to the API in bulk from asyncio code, see
+    BaseLinkUpdateBuffer.
+
+    add() never waits: when the buffer is due, the queued updates are sent
+    by a background task. Updates of a failed send are put back and go out
+    with the next one; flush() and aclose() wait for everything and raise
+    if the final send fails.
+    """
+
+    def __init__(
+        self, client: AsyncApiClient, max_size: int = 200, max_interval: float = 5.0
+    ):
+        super().__init__(client, max_size=max_size, max_interval=max_interval)
+        self.tasks = set()
+
+    def add(self, link_id: int, **fields):
+        """Queue an update of a link, fields set to None are left untouched"""
+        if self._queue(link_id, fields):
+            task = asyncio.create_task(self._send(self._take(), retry_later=True))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, updates: list, retry_later: bool = False):
+        if not updates:
+            return
+
+        try:
+            await self.client.update_links(updates)
+        except Exception as e:
+            if not retry_later:
+                raise
+            logging.error(f"Error sending {len(updates)} link updates: {e}")
+            self._put_back(updates)
+
+    async def flush(self):
+        """Wait for sends in progress, then send everything still queued"""
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+        await self._send(self._take())
+
+    async def aclose(self):
+        await self.flush()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
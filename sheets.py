@@ -2,7 +2,7 @@ import requests
 import csv
 from io import StringIO
 
-from services import check_sent, create_link
+from services import create_links_bulk, create_sent_bulk
 from utils import extract_domain
 
 
@@ -26,12 +26,14 @@ def parse_sheet_save_url(spread_sheet_id: str, sheet_names: list):
 
         reader = csv.reader(f)
 
-        for row in reader:
-            link = extract_domain(row[0])
+        links = list(dict.fromkeys(extract_domain(row[0]) for row in reader if row))
 
-            # Check if email has already been sent to domain
-            if not check_sent(domain=link):
-                create_link(link=link)
+        # Domains already sent to are skipped by the server
+        counts = create_links_bulk(links=links)
+        print(
+            f"Added {counts['inserted']} links, "
+            f"{counts['duplicate']} duplicates, {counts['sent']} already sent"
+        )
 
 
 def add_sent(spread_sheet_id: str, sheet_name: str):
@@ -50,9 +52,7 @@ def add_sent(spread_sheet_id: str, sheet_name: str):
 
     reader = csv.reader(f)
 
-    for row in reader:
-        domain = extract_domain(row[0])
+    domains = list(dict.fromkeys(extract_domain(row[0]) for row in reader if row))
 
-        # Check if email has already been sent to domain
-        if not check_sent(domain=domain):
-            create_link(domain=domain)
+    counts = create_sent_bulk(domains=domains)
+    print(f"Added {counts['inserted']} sent domains, {counts['duplicate']} duplicates")
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from fetcher import fetch_links, html_to_text, looks_js_rendered
+
+PAGES = {
+    "static": (
+        "text/html",
+        "<html><head><title>Jensens VVS</title><style>p {}</style></head>"
+        "<body><h1>Jensens VVS</h1><p>Vi laver badeværelser i hele Aarhus og "
+        "omegn, ring og få et tilbud på dit nye badeværelse.</p>"
+        "<script>track()</script></body></html>",
+    ),
+    "contact": (
+        "text/html",
+        "<html><body><h1>Hansens Tømrer</h1><p>Skriv til os på "
+        "kontakt@hansens-tomrer.dk eller ring, vi svarer inden for en dag.</p>"
+        "</body></html>",
+    ),
+    "js": (
+        "text/html",
+        '<html><body><div id="root"></div><script src="/app.js"></script>'
+        "</body></html>",
+    ),
+    "pdf": ("application/pdf", "%PDF-1.4"),
+}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        content_type, body = PAGES[self.server.page]
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def links():
+    """A local stand-in server per page, as links like '127.0.0.1:8080'"""
+    servers = {}
+    for page in PAGES:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        server.page = page
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers[page] = server
+
+    yield {page: f"127.0.0.1:{server.server_port}" for page, server in servers.items()}
+
+    for server in servers.values():
+        server.shutdown()
+        server.server_close()
+
+
+def fetch(links, tmp_path, **kwargs):
+    records = [(id, links[page]) for id, page in enumerate(PAGES)]
+    # An unused port, so the connection is refused
+    records.append((len(records), "127.0.0.1:1"))
+    updates, browser_links = asyncio.run(fetch_links(records, str(tmp_path), **kwargs))
+    return dict(updates), {id for id, _ in browser_links}
+
+
+def test_html_to_text_skips_hidden_tags():
+    text = html_to_text(PAGES["static"][1])
+    assert text.splitlines()[0] == "Jensens VVS"
+    assert "track()" not in text and "p {}" not in text
+
+
+def test_looks_js_rendered():
+    html = PAGES["js"][1]
+    assert looks_js_rendered(html, html_to_text(html))
+    html = PAGES["static"][1]
+    assert not looks_js_rendered(html, html_to_text(html))
+
+
+def test_fetch_links_without_screenshots(links, tmp_path):
+    updates, browser_ids = fetch(links, tmp_path)
+
+    # static and contact are saved, js, pdf and the refused link need a browser
+    assert set(updates) == {0, 1}
+    assert browser_ids == {2, 3, 4}
+
+    link = links["static"]
+    assert updates[0]["content_file"] == link
+    assert updates[0]["text_digest"]
+    text = (tmp_path / f"{link}.txt").read_text(encoding="utf-8")
+    assert text.startswith("Jensens VVS\nVi laver badeværelser")
+
+
+def test_fetch_links_with_screenshots(links, tmp_path):
+    updates, browser_ids = fetch(links, tmp_path, screenshots=True)
+
+    # The page with an email may become a lead, so it needs a screenshot
+    assert set(updates) == {0}
+    assert browser_ids == {1, 2, 3, 4}
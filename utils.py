@@ -1,5 +1,8 @@
 import io
+import os
+import re
 import csv
+import zlib
 from urllib.parse import urlparse
 
 
@@ -19,12 +22,140 @@ def extract_domain(url):
     return domain
 
 
-def generate_csv(leads, columns):
-    # Generate CSV in memory
+WORD_PATTERN = re.compile(r"\w+")
+SYMBOL_PATTERN = re.compile(r"[^\w\s]")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Fast estimate of the number of LLM tokens in a text.
+
+    Counts a token per started four characters of every word and one per
+    punctuation mark, which tracks BPE tokenizers closely enough for
+    budgeting without loading one.
+    """
+    words = sum((len(word) + 3) // 4 for word in WORD_PATTERN.findall(text))
+    return words + len(SYMBOL_PATTERN.findall(text))
+
+
+def chunked(values, size):
+    """Split an iterable into lists of at most `size` items"""
+    chunk = []
+    for value in values:
+        chunk.append(value)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Values meaning "unknown", as written by the AI parser or found in sheets
+NONE_SENTINELS = {"", "none", "null", "n/a", "na", "nan", "unknown", "ukendt"}
+
+# Text columns of the link table and how they are cased once normalized
+LINK_TEXT_FIELDS = {
+    "email": str.lower,
+    "contact_name": str.title,
+    "pronoun": str.lower,
+    "industry": str.title,
+    "city": str.title,
+    "area": str.title,
+}
+
+
+def normalize_value(value):
+    """Map 'none'-like and empty values to None and lists to their first usable item"""
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            item = normalize_value(item)
+            if item is not None:
+                return item
+        return None
+
+    if isinstance(value, str):
+        value = value.strip()
+        if value.lower() in NONE_SENTINELS:
+            return None
+
+    return value
+
+
+def normalize_link_fields(fields: dict) -> dict:
+    """
+    Normalize the text columns of a link update.
+
+    Unknown values become None (stored as NULL) and the rest are cased
+    canonically, so queries can filter with IS NULL instead of LOWER().
+    Other fields are returned unchanged.
+    """
+    normalized = {}
+    for key, value in fields.items():
+        if key in LINK_TEXT_FIELDS:
+            value = normalize_value(value)
+            if value is not None:
+                value = LINK_TEXT_FIELDS[key](str(value))
+        normalized[key] = value
+    return normalized
+
+
+def iter_csv(batches, columns):
+    """
+    Yield a CSV file as UTF-8 encoded chunks, one per batch of rows.
+
+    The header is yielded before the first batch is requested, so a
+    streamed response starts right away.
+    """
     si = io.StringIO()
     cw = csv.writer(si)
+
     cw.writerow(columns)
-    cw.writerows(leads)
-    output = si.getvalue()
+    yield si.getvalue().encode("utf-8")
+
+    for rows in batches:
+        si.seek(0)
+        si.truncate(0)
+        cw.writerows(rows)
+        yield si.getvalue().encode("utf-8")
+
     si.close()
-    return output
+
+
+def gzip_chunks(chunks, level=6):
+    """Compress a stream of byte chunks into a gzip stream"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# Fingerprints are split in bands for the fingerprint_band index: two
+# fingerprints within FINGERPRINT_BANDS - 1 bits of each other share a band
+FINGERPRINT_BANDS = 8
+FINGERPRINT_BAND_BITS = 8
+
+
+def fingerprint_bands(fingerprint: int) -> list:
+    """(band, value) pairs of a 64 bit fingerprint, as stored by the triggers"""
+    mask = (1 << FINGERPRINT_BAND_BITS) - 1
+    return [
+        (band, (fingerprint >> (band * FINGERPRINT_BAND_BITS)) & mask)
+        for band in range(FINGERPRINT_BANDS)
+    ]
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """Number of differing bits between two 64 bit fingerprints"""
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
+
+
+def screenshot_path(folder: str, link: str) -> str:
+    """Path of a link's screenshot, older scrapes saved it as '<link>.png'"""
+    path = f"{folder}/{link}.jpg"
+    if not os.path.exists(path):
+        legacy_path = f"{folder}/{link}.png"
+        if os.path.exists(legacy_path):
+            return legacy_path
+    return path